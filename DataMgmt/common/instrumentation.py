@@ -0,0 +1,227 @@
+"""
+Measures shared by the instrumentation of the labs.
+
+A Registry records three kinds of measures:
+
+- timings: wall time of the instrumented functions, seen from the client,
+- server: time reported by the server for the requests,
+- counters: round trips, queries, bytes, documents...,
+
+so that the client overhead is the difference between a timing and the
+server time of its requests. Nothing is recorded until the registry is
+enabled, the timers then only cost a call to perf_counter. The measures are
+written to a JSON or Prometheus text file with write(), or served with
+serve(). Each lab keeps its own registry and the hooks of its client in its
+instrument.py, which puts this folder on the path.
+"""
+import functools
+import inspect
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+
+class Stat:
+    """
+    Number, sum and maximum of the observed durations, in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.total, 'max': self.max}
+
+
+class Registry:
+    """
+    Measures of a process, shared by the threads that record them.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.enabled = False
+        self.timings: dict[str, Stat] = {}
+        self.server: dict[str, Stat] = {}
+        self.counters: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._http_server: Optional[ThreadingHTTPServer] = None
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.server.clear()
+            self.counters.clear()
+
+    def observe(self, name: str, seconds: float):
+        if self.enabled:
+            with self._lock:
+                self.timings.setdefault(name, Stat()).observe(seconds)
+
+    def observe_server(self, name: str, seconds: float):
+        if self.enabled:
+            with self._lock:
+                self.server.setdefault(name, Stat()).observe(seconds)
+
+    def count(self, name: str, value: float = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Time the body of a with statement.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: Optional[str] = None) -> Callable:
+        """
+        Decorator timing each call of a function, under its name by default.
+
+        A generator function is timed from its call until it is exhausted or closed.
+        """
+        def decorator(function: Callable) -> Callable:
+            label = name or function.__name__
+
+            if inspect.isgeneratorfunction(function):
+                @functools.wraps(function)
+                def generator(*args, **kwargs):
+                    if not self.enabled:
+                        return (yield from function(*args, **kwargs))
+                    with self.timer(label):
+                        return (yield from function(*args, **kwargs))
+                return generator
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.timer(label):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'timings': {name: stat.to_dict() for name, stat in sorted(self.timings.items())},
+                'server': {name: stat.to_dict() for name, stat in sorted(self.server.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self) -> str:
+        """
+        The measures in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for kind, help_text in (('timings', 'Wall time of the calls seen from the client'),
+                                ('server', 'Time reported by the server for the requests')):
+            metric = f"{self.prefix}_{'call' if kind == 'timings' else 'server'}_seconds"
+            lines += [f"# HELP {metric} {help_text}.", f"# TYPE {metric} summary"]
+            for name, stat in snapshot[kind].items():
+                lines.append(f'{metric}_count{{name="{name}"}} {stat["count"]}')
+                lines.append(f'{metric}_sum{{name="{name}"}} {stat["sum"]:.6f}')
+            max_metric = f"{metric}_max"
+            lines += [f"# TYPE {max_metric} gauge"]
+            for name, stat in snapshot[kind].items():
+                lines.append(f'{max_metric}{{name="{name}"}} {stat["max"]:.6f}')
+        metric = f"{self.prefix}_events_total"
+        lines += [f"# HELP {metric} Round trips, queries, bytes and items processed.", f"# TYPE {metric} counter"]
+        for name, value in snapshot['counters'].items():
+            lines.append(f'{metric}{{name="{name}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the measures to path, in the Prometheus text format if its suffix is .prom, else in JSON.
+        """
+        path = Path(path)
+        tmp = path.with_name(path.name + '.tmp')
+        with tmp.open('w') as f:
+            if path.suffix == '.prom':
+                f.write(self.prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=2)
+        tmp.replace(path)
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """
+        Serve the measures in the Prometheus text format on http://host:port/metrics, from a daemon thread.
+
+        The thread stops with the process, see finish() to keep serving once the work is done.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self._http_server = server
+        return server
+
+    def configure(self, path: Optional[Path] = None, port: Optional[int] = None):
+        """
+        Enable the registry if the measures are to be written to path or served on port.
+        """
+        if path is not None or port is not None:
+            self.enable()
+        if port is not None:
+            self.serve(port)
+
+    def finish(self, path: Optional[Path] = None):
+        """
+        Write the measures to path if given, and keep serving them until interrupted if they are served,
+        so that the endpoint can still be scraped once a batch script is done.
+        """
+        if path is not None:
+            self.write(path)
+        if self._http_server is None:
+            return
+        host, port = self._http_server.server_address[:2]
+        print(f"Serving the measures on http://{host}:{port}/metrics, press Ctrl-C to stop", file=sys.stderr)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
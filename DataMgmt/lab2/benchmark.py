@@ -0,0 +1,184 @@
+#!/bin/env python
+"""
+Benchmark of the indexing and search throughput of each analyzer.
+
+The corpus is a synthetic one scaled from cacm.v2.ndjson, indexed either in
+the Elasticsearch of docker-compose.yml or offline. Results are written as
+JSON so that runs of different releases can be compared.
+"""
+import argparse
+import itertools
+import json
+import logging
+import math
+import random
+import resource
+import sys
+import time
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from elasticsearch import Elasticsearch
+from elasticsearch_dsl.analysis import Analyzer
+
+from evaluate import read_queries
+from index import (Client, create_index, get_analyzer_definition, get_analyzers,
+                   msearch, search, stream_documents)
+from loaders import load_corpus
+from offline import OfflineClient
+
+
+BENCHMARK_INDEX_PREFIX = 'bench_'
+
+
+def synthetic_docs(scale: float, seed: int = 0) -> Iterator[dict]:
+    """
+    Yield about `scale` times the documents of the corpus.
+
+    Each copy of a document gets a new id and the words of its fields are
+    shuffled, so that copies are not identical but keep the same vocabulary
+    and length distribution.
+    """
+    rng = random.Random(seed)
+    corpus = load_corpus()
+    max_id = int(corpus.doc_ids.max())
+    n_docs = math.ceil(len(corpus) * scale)
+
+    copies = (
+        (copy, doc)
+        for copy in itertools.count()
+        for doc in corpus
+    )
+    for copy, doc in itertools.islice(copies, n_docs):
+        if copy == 0:
+            yield doc
+            continue
+        synthetic = {'_id': copy * max_id + doc['_id']}
+        for field in ('title', 'summary'):
+            if field in doc:
+                words = doc[field].split()
+                rng.shuffle(words)
+                synthetic[field] = ' '.join(words)
+        yield synthetic
+
+
+def latency_stats(latencies: list[float]) -> dict:
+    """
+    Summarize latencies in seconds as milliseconds percentiles.
+    """
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {
+        'count': len(latencies),
+        'mean_ms': float(np.mean(latencies) * 1000),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'max_ms': float(np.max(latencies) * 1000),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+def benchmark_indexing(client: Client, index_name: str, definition: dict, a: Analyzer,
+                       scale: float, chunk_size: int, thread_count: int) -> dict:
+    start = time.perf_counter()
+    if isinstance(client, OfflineClient):
+        client.create_index(index_name, definition, synthetic_docs(scale))
+        n_docs = len(client.get_index(index_name).doc_ids)
+    else:
+        create_index(a, client, index_name)
+        n_docs = stream_documents(synthetic_docs(scale), index_name, client, chunk_size, thread_count)
+        client.indices.refresh(index=index_name)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'docs': n_docs,
+        'seconds': elapsed,
+        'docs_per_second': n_docs / elapsed,
+    }
+
+
+def benchmark_search(client: Client, index_name: str, queries: list[str],
+                     repeat: int, k: int, batch_size: int) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            query_start = time.perf_counter()
+            search(query, index_name, client, k=k)
+            latencies.append(time.perf_counter() - query_start)
+    single = latency_stats(latencies)
+    single['queries_per_second'] = len(latencies) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        msearch(queries, index_name, client, batch_size, k=k)
+    batched = {'queries_per_second': repeat * len(queries) / (time.perf_counter() - start)}
+
+    return {'search': single, 'msearch': batched}
+
+
+def main(scale: float = 1.0, repeat: int = 3, k: int = 10, batch_size: int = 64,
+         chunk_size: int = 500, thread_count: int = 4, offline: Path = None) -> dict:
+    client = OfflineClient(offline) if offline else Elasticsearch()
+    queries = list(read_queries().values())
+
+    results = {
+        'backend': 'offline' if offline else 'elasticsearch',
+        'scale': scale,
+        'repeat': repeat,
+        'k': k,
+        'analyzers': {},
+    }
+    for a in get_analyzers():
+        index_name = BENCHMARK_INDEX_PREFIX + a._name
+        logging.info(f"Benchmarking {index_name}")
+        results['analyzers'][a._name] = {
+            'indexing': benchmark_indexing(client, index_name, get_analyzer_definition(a), a,
+                                           scale, chunk_size, thread_count),
+            **benchmark_search(client, index_name, queries, repeat, k, batch_size),
+        }
+        if not offline:
+            client.indices.delete(index=index_name, ignore=404)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Benchmark indexing and search of each analyzer.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="size of the synthetic corpus relative to the CACM corpus")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of times the queries are run")
+    parser.add_argument("-k", type=int, default=10,
+                        help="number of documents retrieved per query")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="number of queries sent per multi search request")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="number of documents per bulk request")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="number of bulk threads")
+    parser.add_argument("--offline", type=Path, metavar="DIR",
+                        help="benchmark in-process indices built in DIR instead of Elasticsearch")
+    parser.add_argument("--output", type=Path, metavar="FILE",
+                        help="write the results to FILE instead of stdout")
+    args = parser.parse_args()
+
+    results = main(scale=args.scale, repeat=args.repeat, k=args.k, batch_size=args.batch_size,
+                   chunk_size=args.chunk_size, thread_count=args.threads, offline=args.offline)
+
+    if args.output:
+        with args.output.open('w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
@@ -0,0 +1,152 @@
+"""
+Cache of search results, invalidated when an index is rebuilt.
+
+Each time create_indices builds an index, a new generation is recorded for it
+in GENERATIONS_PATH together with the definition of its analyzer. Cached
+results are keyed by the backend, the index, its generation, the analyzer
+fingerprint and the query, so results of a previous build are never served.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from offline import OfflineClient
+
+
+GENERATIONS_PATH = Path(__file__).resolve().parent / 'index_generations.json'
+"""File recording the current generation of each index, next to this module so that
+index.py and evaluate.py share it whatever their working directory"""
+
+_generations_lock = threading.Lock()
+
+
+def backend_id(client) -> str:
+    """
+    Identify the backend serving the indices, so that indices with the same
+    name on a cluster and offline do not share results.
+    """
+    if isinstance(client, OfflineClient):
+        return f"offline:{client.root.resolve()}"
+    hosts = getattr(getattr(client, 'transport', None), 'hosts', None)
+    return f"elasticsearch:{json.dumps(hosts, sort_keys=True, default=str)}"
+
+
+def read_generations(path: Path = GENERATIONS_PATH) -> dict[str, dict]:
+    if not path.exists():
+        return {}
+    with path.open() as f:
+        return json.load(f)
+
+
+def record_generation(client, index_name: str, analyzer_definition: dict,
+                      path: Path = GENERATIONS_PATH) -> str:
+    """
+    Record that an index has just been (re)built and return its new generation.
+    """
+    generation = uuid.uuid4().hex
+    fingerprint = hashlib.sha256(json.dumps(analyzer_definition, sort_keys=True).encode()).hexdigest()
+    with _generations_lock:
+        generations = read_generations(path)
+        generations[f"{backend_id(client)}/{index_name}"] = {
+            "generation": generation,
+            "analyzer": analyzer_definition,
+            "fingerprint": fingerprint,
+        }
+        tmp = path.with_suffix('.tmp')
+        with tmp.open('w') as f:
+            json.dump(generations, f, indent=2)
+        tmp.replace(path)
+    return generation
+
+
+class SearchCache:
+    """
+    Bounded LRU cache of search results with an optional on-disk store.
+
+    Only indices with a recorded generation are cached: results of indices
+    created by hand cannot be invalidated, so they are always searched.
+    Entries of the disk store whose generation is not current anymore are
+    deleted when the cache is opened.
+    """
+
+    def __init__(self, max_size: int = 10_000, path: Optional[Path] = None,
+                 generations_path: Path = GENERATIONS_PATH):
+        self.max_size = max_size
+        self.generations = read_generations(generations_path)
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, list[int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, index_key TEXT, generation TEXT, doc_ids TEXT)"
+            )
+            current = [(k, g["generation"]) for k, g in self.generations.items()]
+            self._db.execute("CREATE TEMP TABLE current (index_key TEXT, generation TEXT)")
+            self._db.executemany("INSERT INTO current VALUES (?, ?)", current)
+            self._db.execute(
+                "DELETE FROM results WHERE NOT EXISTS (SELECT 1 FROM current c "
+                "WHERE c.index_key = results.index_key AND c.generation = results.generation)"
+            )
+            self._db.commit()
+
+    def _key(self, client, index_name: str, query: str, params: dict) -> Optional[tuple[str, str, str]]:
+        index_key = f"{backend_id(client)}/{index_name}"
+        generation = self.generations.get(index_key)
+        if generation is None:
+            return None
+        payload = json.dumps([index_key, generation["generation"], generation["fingerprint"], query, params],
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest(), index_key, generation["generation"]
+
+    def get(self, client, index_name: str, query: str, **params) -> Optional[list[int]]:
+        key = self._key(client, index_name, query, params)
+        if key is None:
+            return None
+
+        with self._lock:
+            doc_ids = self._entries.get(key[0])
+            if doc_ids is not None:
+                self._entries.move_to_end(key[0])
+            elif self._db is not None:
+                row = self._db.execute("SELECT doc_ids FROM results WHERE key = ?", (key[0],)).fetchone()
+                if row is not None:
+                    doc_ids = json.loads(row[0])
+                    self._remember(key[0], doc_ids)
+
+            if doc_ids is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return doc_ids
+
+    def put(self, client, index_name: str, query: str, doc_ids: list[int], **params):
+        key = self._key(client, index_name, query, params)
+        if key is None:
+            return
+
+        with self._lock:
+            self._remember(key[0], doc_ids)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                 (key[0], key[1], key[2], json.dumps(doc_ids)))
+                self._db.commit()
+
+    def _remember(self, key: str, doc_ids: list[int]):
+        self._entries[key] = doc_ids
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
@@ -1,9 +1,12 @@
 #!/bin/env python
+import argparse
+import json
 import logging
 import pprint
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from collections import defaultdict
-from types import SimpleNamespace
+from typing import Callable
 import matplotlib.pyplot as plt
 
 from elasticsearch import Elasticsearch, client
@@ -16,140 +19,81 @@ from elasticsearch_dsl.document import Document
 from elasticsearch_dsl.field import Text
 from elasticsearch_dsl.query import MultiMatch
 
-from index import get_index_names, search, QueryId, DocId
+import instrument
+import loaders
+from cache import SearchCache
+from index import get_index_names, msearch, Client, QueryId, DocId
+from offline import OfflineClient
+from metrics import RECALL_LEVELS, RankingMetrics, compute_metrics, query_records
 
 
-class RankingMetrics(SimpleNamespace):
-    """
-    Simple class to store the metrics of an index.
-
-    This class does not store metrics for individual queries.
-    """
-    index_name: str
-
-    total_retrieved_docs: int = 0 
-    """Sum of the number retrieved documents of each query"""
-
-    total_relevant_docs: int = 0
-    """Sum of the number of relevant documents for each query"""
-
-    total_retrieved_relevant_docs: int = 0
-    """Sum of the number of relevant documents retrieved for each query"""
-
-    avg_precision: float = 0.0
-    """Average of the precision of each query"""
+Run = dict[QueryId, list[DocId]]
 
-    avg_recall: float = 0.0
-    """Average of the recall of each query"""
 
-    f_measure: float = 0.0
-    """F-Measure calculated from avg_precision and avg_recall"""
+def search_run(index_name: str,
+               queries: dict[QueryId, str],
+               client: Client,
+               batch_size: int = 64,
+               cache: SearchCache = None,
+               k: int = 10) -> Run:
+    """
+    Returns the ranked documents retrieved by an index for each query.
+    """
+    # Send all the queries through the multi search API, batch_size at a time
+    results = msearch(list(queries.values()), index_name, client, batch_size, cache, k)
+    return dict(zip(queries.keys(), results))
 
-    mean_average_precision: float = 0.0
-    """Mean of the average precision (AP) of each query"""
 
-    avg_r_precision: float = 0.0
-    """Average of the R-Precision of each query"""
+def evaluate_index(index_name: str, 
+                   queries: dict[QueryId, str], 
+                   qrels: dict[QueryId, set[DocId]], 
+                   client: Client,
+                   batch_size: int = 64,
+                   cache: SearchCache = None,
+                   k: int = 10) -> RankingMetrics:
+    run = search_run(index_name, queries, client, batch_size, cache, k)
 
-    avg_precision_at_recall_level: list[float] = [0.0] * 11
-    """Average of the precision at the 11 standard recall levels of each query"""
+    # The metrics of all the queries are computed at once on a relevance matrix
+    return compute_metrics(index_name, run, qrels)
 
 
-def get_max_precision_recall(recalls, recall):
-    max = 0
-    for k in recalls:
-        if k[0] == recall and k[1] > max:
-            max = k[1]
-            break
-    return max
+def read_run(path: Path) -> tuple[str, Run]:
+    """
+    Read a TREC run file, made of "query_id Q0 doc_id rank score tag" lines.
 
-def evaluate_index(index_name: str, 
-                   queries: dict[QueryId, str], 
-                   qrels: dict[QueryId, set[DocId]], 
-                   client: Elasticsearch):
-    # Initialize metrics for the current index evaluation
-    m = RankingMetrics()
-    m.index_name = index_name
-    # TODO: for each query calculate the metrics and then summarize them in m
-    matching_queries = []
-    matching_qrels = []
-    avg_p_for_each_query= []
-    recall_for_each_query = []
-    precision_sum = 0.0
-    recall_sum = 0.0
-    avg_r_precision_sum = 0.0
-    
-    for q, q_str in queries.items():
-        res = search(q_str, index_name, client)
-        count_nbr_of_doc_correct = 1
-        avg_prec = []
-        recalls = []
-        for i in range(1, len(res)+2):
-            avg_prec.append(count_nbr_of_doc_correct/i)
-            if qrels[q]:
-                recall = count_nbr_of_doc_correct/len(qrels[q])
-            else:
-                if i==1:
-                    recall = 0
-                else:
-                    recall = recalls[i-2]
-
-            recalls.append((recall, count_nbr_of_doc_correct/i))
-            if res[i-2] in qrels[q]:
-                count_nbr_of_doc_correct += 1
-            
-        avg_p_for_each_query.append(sum(avg_prec)/len(avg_prec))
-        recall_for_each_query.append(recalls)
-        matching_queries+= res
-        matching_qrels+= qrels[q]
-        precision_sum+= len(list(set(qrels[q]) & set(res))) / len(res)
-        if len(qrels[q]):
-            recall_sum+= len(list(set(qrels[q]) & set(res))) / len(qrels[q])
-            R_doc = len(qrels[q])
-            res = res[:R_doc]
-            avg_r_precision_sum  += len(list(set(qrels[q]) & set(res))) / R_doc
-
-    global_prec_recall = []
-    
-    for k in recall_for_each_query:
-        prec_recall = []
-        for i in range(11):
-            max_prec_recall = get_max_precision_recall(k, k[i][0])
-            prec_recall.append((i/10, max_prec_recall))
-        global_prec_recall.append(prec_recall)
-    
-    mean_prec_recall = []
-
-    for i in range(11):
-        sum_prec = 0 
-        for q in global_prec_recall:
-            sum_prec += q[i][1]
-        mean_prec_recall.append(sum_prec/len(queries))
-    
-    m.total_retrieved_docs = len(matching_queries)
-    m.total_relevant_docs = len(matching_qrels)
-    m.total_retrieved_relevant_docs =  len(list(set(matching_queries) & set(matching_qrels)))
-    m.avg_precision = precision_sum / len(queries)
-    m.avg_recall = recall_sum / len(queries)
-    m.f_measure = (2*m.avg_precision*m.avg_recall)/(m.avg_recall+m.avg_precision)
-    m.mean_average_precision = sum(avg_p_for_each_query)/len(avg_p_for_each_query)
-    m.avg_r_precision = avg_r_precision_sum/ len(queries)
-    m.avg_precision_at_recall_level = mean_prec_recall
-    return m
+    Returns the tag of the run (the name of the file if there is none) and
+    the documents of each query, by decreasing score then increasing rank.
+    """
+    entries = defaultdict(list)
+    tag = None
+    with path.open() as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            query_id, _, doc_id, rank, score = fields[:5]
+            tag = tag or (fields[5] if len(fields) > 5 else None)
+            entries[int(query_id)].append((-float(score), int(rank), int(doc_id)))
+    run = {query_id: [doc_id for _, _, doc_id in sorted(docs)] for query_id, docs in entries.items()}
+    return tag or path.stem, run
+
+
+def write_run(path: Path, name: str, run: Run):
+    """
+    Write a run in the TREC format. The searches only return the ranked ids,
+    so the score of a document is the opposite of its rank.
+    """
+    with path.open("w") as f:
+        for query_id, doc_ids in run.items():
+            for rank, doc_id in enumerate(doc_ids, start=1):
+                f.write(f"{query_id} Q0 {doc_id} {rank} {-rank} {name}\n")
 
 
 def read_queries() -> dict[QueryId, str]:
     """
     Returns a dictionary that contains for each query id the query phrase.
     """
-    QUERY_SEPARATOR = "\t"
-    QUERIES_PATH = Path('evaluation') / "query.txt"
-    
-    with QUERIES_PATH.open() as f:
-        lines = [line.strip() for line in f.readlines()]
-        parsed = [line.split(QUERY_SEPARATOR) for line in lines if line != ""]
-        queries = {int(p[0]): p[1] for p in parsed}
-        return queries
+    return loaders.read_queries()
 
 
 def read_qrels() -> dict[QueryId, set[DocId]]:
@@ -157,49 +101,125 @@ def read_qrels() -> dict[QueryId, set[DocId]]:
     Returns a dictionary that contains for each query id the set of relevant document ids.
     When accessing a unknown query id, the dictionary returns an empty set.
     """
-    QREL_SEPARATOR = ";"
-    DOC_SEPARATOR = ","
-    QRELS_PATH = Path('evaluation') / "qrels.txt"
-
-    with QRELS_PATH.open() as f:
-        lines = [line.strip() for line in f.readlines()]
-        parsed = [line.split(QREL_SEPARATOR) for line in lines if line != ""]
-        qrels = defaultdict(set)
-        for p in parsed:
-            query_id = int(p[0])
-            docs = set(int(d) for d in p[1].split(DOC_SEPARATOR))
-            qrels[query_id] = docs
-        return qrels
+    return loaders.read_qrels()
 
-def plot_graph(precision_recall_list):
-    plt.plot(precision_recall_list, '-ok')
-    plt.show()
 
-
-
-def main():
+def plot_curves(all_metrics: list[RankingMetrics], path: Path):
+    """
+    Draw the 11-point precision-recall curves of all the runs in one image.
+    """
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for metrics in all_metrics:
+        ax.plot(RECALL_LEVELS, metrics.avg_precision_at_recall_level, '-o', label=metrics.index_name)
+    ax.set_xlabel("Recall")
+    ax.set_ylabel("Interpolated precision")
+    ax.set_xlim(0.0, 1.0)
+    ax.set_ylim(0.0, 1.05)
+    ax.grid(True)
+    ax.legend()
+    fig.savefig(path, bbox_inches="tight")
+    plt.close(fig)
+
+
+def main(batch_size: int = 64, workers: int = 1, offline: Path = None,
+         cache_path: Path = None, k: int = 10, run_paths: list[Path] = (),
+         indices: bool = True, per_query_path: Path = Path("per_query.jsonl"),
+         plot_path: Path = Path("precision_recall.png"), runs_dir: Path = None):
     queries = read_queries()
-    qrels = read_qrels()
+    qrels = loaders.load_qrels()
 
-    client = Elasticsearch()
+    client = OfflineClient(offline) if offline else Elasticsearch(connection_class=instrument.InstrumentedConnection)
+    cache = SearchCache(path=cache_path) if cache_path else None
 
     # If you want to evaluate manualy created indices, you can
     # list their names here.
     manual_indices = []
 
-    indices = get_index_names()
-    indices.extend(manual_indices)
+    # Each job returns the run to evaluate: the searches of an index, or a run file
+    jobs: dict[str, Callable[[], Run]] = {}
+    index_names = get_index_names() + manual_indices if indices else []
+    for index in index_names:
+        jobs[index] = lambda index=index: search_run(index, queries, client, batch_size, cache, k)
+    for path in run_paths:
+        name, run = read_run(path)
+        # queries missing from a run file retrieved nothing
+        jobs[name] = lambda run=run: {query_id: run.get(query_id, []) for query_id in queries}
+
+    def evaluate(name: str) -> tuple[RankingMetrics, Run]:
+        with instrument.timer("run"):
+            run = jobs[name]()
+        with instrument.timer("compute_metrics"):
+            return compute_metrics(name, run, qrels), run
+
+    # Runs are independent, so they are evaluated concurrently and the metrics
+    # of each query are written as soon as its run is done. metrics.txt keeps
+    # the order of the jobs to stay deterministic.
+    all_metrics = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor, per_query_path.open("w") as per_query_fp:
+        futures = {executor.submit(evaluate, name): name for name in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            metrics, run = future.result()
+            per_query = metrics.per_query
+            for record in query_records(name, per_query.query_ids.tolist(), per_query.arrays):
+                per_query_fp.write(json.dumps(record) + "\n")
+            per_query_fp.flush()
+            if runs_dir is not None and name in index_names:
+                runs_dir.mkdir(parents=True, exist_ok=True)
+                write_run(runs_dir / f"{name}.run", name, run)
+            all_metrics[name] = metrics
+            logging.info(f"Evaluated {name}")
 
     with open("metrics.txt", "w") as metric_fp:
-        for index in indices:
-            metrics = evaluate_index(index, queries, qrels, client)
-            pprint.pprint(metrics, metric_fp)
-            pprint.pprint(metrics)  # Also print to stdout
+        for name in jobs:
+            pprint.pprint(all_metrics[name], metric_fp)
+            pprint.pprint(all_metrics[name])  # Also print to stdout
+
+    if plot_path is not None:
+        plot_curves([all_metrics[name] for name in jobs], plot_path)
 
-            plot_graph(metrics.avg_precision_at_recall_level)
+    if cache is not None:
+        logging.info("Search cache: %d hits, %d misses" % (cache.hits, cache.misses))
+        cache.close()
 
 if __name__ == "__main__":
     # execute only if run as a script
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
                         level=logging.WARN)
-    main()
+
+    parser = argparse.ArgumentParser(description="Evaluate the CACM indices.")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="number of queries sent per multi search request")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of indices evaluated concurrently")
+    parser.add_argument("--offline", type=Path, metavar="DIR",
+                        help="evaluate the in-process indices of DIR instead of Elasticsearch")
+    parser.add_argument("-k", type=int, default=10,
+                        help="number of documents retrieved per query")
+    parser.add_argument("--cache", type=Path, metavar="FILE",
+                        help="cache the search results in FILE between runs")
+    parser.add_argument("--run", type=Path, action="append", default=[], metavar="FILE", dest="runs",
+                        help="also evaluate the TREC run FILE, can be repeated")
+    parser.add_argument("--runs-only", action="store_true",
+                        help="only evaluate the run files, not the indices")
+    parser.add_argument("--save-runs", type=Path, metavar="DIR",
+                        help="write the run of each index to DIR in the TREC format")
+    parser.add_argument("--per-query", type=Path, default=Path("per_query.jsonl"), metavar="FILE",
+                        help="JSON lines file of the metrics of each query of each run")
+    parser.add_argument("--plot", type=Path, default=Path("precision_recall.png"), metavar="FILE",
+                        help="image of the precision-recall curves of all the runs")
+    parser.add_argument("--metrics", type=Path, metavar="FILE",
+                        help="write timings, counters and server times to FILE (Prometheus text if it ends with .prom)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve timings, counters and server times on http://127.0.0.1:PORT/metrics, "
+                             "until interrupted once the work is done")
+    args = parser.parse_args()
+
+    # the curves are only saved to an image, no window is opened
+    plt.switch_backend("Agg")
+
+    instrument.configure(args.metrics, args.metrics_port)
+    main(batch_size=args.batch_size, workers=args.workers, offline=args.offline,
+         cache_path=args.cache, k=args.k, run_paths=args.runs, indices=not args.runs_only,
+         per_query_path=args.per_query, plot_path=args.plot, runs_dir=args.save_runs)
+    instrument.finish(args.metrics)
@@ -1,15 +1,25 @@
 #!/bin/env python
+import argparse
+import itertools
 import logging
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers.actions import bulk
-from elasticsearch_dsl import Search, Index
-from elasticsearch_dsl.analysis import Analyzer, analyzer, token_filter, tokenizer
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from typing import Iterable, Iterator, Optional, Union
+from elasticsearch import Elasticsearch, ConnectionError, ConnectionTimeout
+from elasticsearch.helpers.actions import bulk, streaming_bulk
+from elasticsearch_dsl import Search, MultiSearch, Index
+from elasticsearch_dsl.analysis import Analyzer, CustomAnalyzer, analyzer, token_filter, tokenizer
 from elasticsearch_dsl.document import Document
 from elasticsearch_dsl.field import Text
 from elasticsearch_dsl.query import MultiMatch
 from pathlib import Path
 import json
 
+import instrument
+from cache import SearchCache, record_generation
+from loaders import load_corpus
+from offline import OfflineClient
+
 
 QueryId = int
 """Type alias for the id of a query"""
@@ -17,32 +27,144 @@ QueryId = int
 DocId = int
 """Type alias for the id of a document"""
 
+Client = Union[Elasticsearch, OfflineClient]
+"""Type alias for the backend serving the indices, a cluster or offline indices"""
+
 
-def search(query: str, index_name: str, client: Elasticsearch) -> list[DocId]:
+@instrument.timed()
+def iter_search(query: str, index_name: str, client: Client, k: Optional[int] = 10,
+                page_size: int = 1000) -> Iterator[tuple[DocId, float]]:
     """
-    Search a given query on the summary and title fields of the given index.
+    Lazily yield the (id, score) pairs of the documents matching a given query
+    on the summary and title fields of the given index, best first.
 
-    Returns the ids of the matching documents.
+    At most `k` hits are yielded, or all the matching documents if k is None.
+    Only ids and scores are fetched, not the documents. When more than
+    `page_size` hits are needed, pages are fetched one after another with
+    search_after in a point in time, so that deep results stay consistent
+    while the index is updated.
     """
+    if isinstance(client, OfflineClient):
+        yield from client.iter_search(query, index_name, k)
+        return
+
     q = MultiMatch(query=query, fields=["summary", "title"])
-    s = Search(using=client, index=index_name) \
-        .query(q)
-    hits = s.execute() \
-        .hits.hits
-    doc_ids = [int(hit['_id']) for hit in hits]
+
+    if k is not None and k <= page_size:
+        s = Search(using=client, index=index_name) \
+            .query(q) \
+            .source(False)[:k]
+        for hit in s.execute().hits.hits:
+            yield int(hit['_id']), hit['_score']
+        return
+
+    pit_id = client.open_point_in_time(index=index_name, keep_alive='1m')['id']
+    try:
+        remaining = k
+        search_after = None
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            s = Search(using=client) \
+                .query(q) \
+                .source(False) \
+                .sort({'_score': 'desc'}) \
+                .extra(size=size, track_total_hits=False, pit={'id': pit_id, 'keep_alive': '1m'})
+            if search_after is not None:
+                s = s.extra(search_after=search_after)
+
+            response = s.execute()
+            pit_id = response.pit_id
+            hits = response.hits.hits
+            for hit in hits:
+                yield int(hit['_id']), hit['_score']
+            if len(hits) < size:
+                break
+            search_after = hits[-1]['sort']
+            if remaining is not None:
+                remaining -= len(hits)
+    finally:
+        client.close_point_in_time(body={'id': pit_id})
+
+
+@instrument.timed()
+def search(query: str, index_name: str, client: Client,
+           cache: SearchCache = None, k: int = 10) -> list[DocId]:
+    """
+    Search a given query on the summary and title fields of the given index.
+
+    If a cache is given, results of the current generation of the index are
+    served from it.
+
+    Returns the ids of the k best matching documents.
+    """
+    if cache is not None:
+        doc_ids = cache.get(client, index_name, query, k=k)
+        instrument.count("cache_misses" if doc_ids is None else "cache_hits")
+        if doc_ids is None:
+            # the undecorated function, so that a miss is not timed as a second search
+            doc_ids = search.__wrapped__(query, index_name, client, k=k)
+            cache.put(client, index_name, query, doc_ids, k=k)
+        return doc_ids
+
+    doc_ids = [doc_id for doc_id, _ in iter_search(query, index_name, client, k)]
     return doc_ids
 
 
-def read_docs() -> list[dict]:
-    NDJSON_PATH = Path('data') / "cacm.v2.ndjson"
+@instrument.timed()
+def msearch(queries: list[str], index_name: str, client: Client,
+            batch_size: int = 64, cache: SearchCache = None, k: int = 10) -> list[list[DocId]]:
+    """
+    Search several queries on the summary and title fields of the given index.
+
+    The queries are sent in batches of `batch_size` through the multi search
+    API, so only one round trip is made per batch instead of one per query.
+    If a cache is given, only the queries missing from it are sent. `k` is
+    limited by the max_result_window of the index (10000 by default), use
+    iter_search() to go deeper.
+
+    Returns, in the same order as `queries`, the ids of the k best matching documents.
+    """
+    if cache is not None:
+        cached = [cache.get(client, index_name, query, k=k) for query in queries]
+        missing = [query for query, doc_ids in zip(queries, cached) if doc_ids is None]
+        instrument.count("cache_hits", len(queries) - len(missing))
+        instrument.count("cache_misses", len(missing))
+        fetched = iter(msearch.__wrapped__(missing, index_name, client, batch_size, k=k))
+        results = []
+        for query, doc_ids in zip(queries, cached):
+            if doc_ids is None:
+                doc_ids = next(fetched)
+                cache.put(client, index_name, query, doc_ids, k=k)
+            results.append(doc_ids)
+        return results
 
-    with NDJSON_PATH.open() as f:
-        lines = f.readlines()
-        docs = [json.loads(l) for l in lines]
+    instrument.count("queries", len(queries))
+    if isinstance(client, OfflineClient):
+        return [client.search(query, index_name, k) for query in queries]
 
-        return docs
+    results: list[list[DocId]] = []
+    for start in range(0, len(queries), batch_size):
+        ms = MultiSearch(using=client, index=index_name)
+        for query in queries[start:start + batch_size]:
+            q = MultiMatch(query=query, fields=["summary", "title"])
+            ms = ms.add(Search().query(q).source(False)[:k])
+        for response in ms.execute():
+            results.append([int(hit['_id']) for hit in response.hits.hits])
+    return results
+
+
+def iter_docs() -> Iterator[dict]:
+    """
+    Lazily yield the documents of the corpus, decoding one line at a time.
+    """
+    return iter(load_corpus())
 
 
+def read_docs() -> list[dict]:
+    return list(iter_docs())
+
+
+@instrument.timed()
 def upload_documents(docs: list[dict], index: str, client: Elasticsearch):
     """
     Use bulk insert to upload the given documents to a specified index.
@@ -52,9 +174,78 @@ def upload_documents(docs: list[dict], index: str, client: Elasticsearch):
     successes, errors = bulk(
         client=client, index=index, actions=docs,
     )
+    instrument.count("documents_indexed", successes)
     logging.info("Indexed %d/%d documents" % (successes, len(docs)))
 
 
+def _chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+@instrument.timed()
+def _upload_chunk(chunk: list[dict], index: str, client: Elasticsearch,
+                  max_retries: int, initial_backoff: float) -> int:
+    """
+    Bulk insert one chunk of documents and return the number of successes.
+
+    Documents rejected because the cluster is overloaded (429) are retried by
+    streaming_bulk with an exponential backoff. If the whole request fails on
+    a connection error, the chunk is sent again: documents carry their `_id`,
+    so re-indexing them is idempotent.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            successes = 0
+            for ok, _ in streaming_bulk(
+                client=client, index=index, actions=chunk, chunk_size=len(chunk),
+                max_retries=max_retries, initial_backoff=initial_backoff,
+            ):
+                successes += ok
+            return successes
+        except (ConnectionError, ConnectionTimeout):
+            if attempt == max_retries:
+                raise
+            backoff = initial_backoff * 2 ** attempt
+            instrument.count("bulk_retries")
+            logging.warning("Bulk chunk failed on %s, retrying in %.1fs" % (index, backoff))
+            time.sleep(backoff)
+
+
+@instrument.timed()
+def stream_documents(docs: Iterable[dict], index: str, client: Elasticsearch,
+                     chunk_size: int = 500, thread_count: int = 4,
+                     max_retries: int = 5, initial_backoff: float = 2) -> int:
+    """
+    Upload a stream of documents to a specified index with parallel bulk inserts.
+
+    The documents are consumed lazily in chunks of `chunk_size` and sent by
+    `thread_count` threads. At most two chunks per thread are in flight: the
+    reader waits for a chunk to complete before reading further, so memory
+    stays bounded whatever the size of the corpus.
+
+    Returns the number of documents indexed.
+    """
+    successes = 0
+    total = 0
+    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+        pending = set()
+        for chunk in _chunked(docs, chunk_size):
+            if len(pending) >= 2 * thread_count:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                successes += sum(f.result() for f in done)
+            pending.add(executor.submit(
+                _upload_chunk, chunk, index, client, max_retries, initial_backoff
+            ))
+            total += len(chunk)
+        successes += sum(f.result() for f in pending)
+
+    instrument.count("documents_indexed", successes)
+    logging.info("Indexed %d/%d documents" % (successes, total))
+    return successes
+
+
 def get_analyzers() -> list[Analyzer]:
     analyzers: list[Analyzer] = [
         analyzer('standard'),
@@ -68,31 +259,79 @@ def get_analyzers() -> list[Analyzer]:
 def generate_index_name_from_analyzer(a: Analyzer) -> str:
     index_name = 'cacm_' + a._name
     return index_name
+
+
+def get_analyzer_definition(a: Analyzer) -> dict:
+    """
+    Returns the definition of an analyzer, builtin analyzers being of their own type.
+    """
+    if isinstance(a, CustomAnalyzer):
+        return a.get_definition()
+    return {'type': a._name}
         
 
-def create_indices(client: Elasticsearch) -> list[str]:
+@instrument.timed()
+def create_index(a: Analyzer, client: Elasticsearch, index_name: str = None) -> str:
+    """
+    (Re)create an empty index whose title and summary fields use the given analyzer.
+
+    The index is named after the analyzer unless a name is given.
+    """
+    index_name = index_name or generate_index_name_from_analyzer(a)
+
+    index = Index(index_name)
+    index.analyzer(a)
+
+    # Specify mapping
+    @index.document
+    class Article(Document):
+        title = Text(analyzer=a)
+        summary = Text(analyzer=a)
+
+    index.delete(ignore=404, using=client)
+    index.create(using=client)
+    return index_name
+
+
+@instrument.timed()
+def create_indices(client: Client, streaming: bool = False,
+                   chunk_size: int = 500, thread_count: int = 4) -> list[str]:
     """
     Create an index for each analyzers.
+
+    In streaming mode, all the indices are built concurrently and each one
+    reads the corpus lazily, so memory does not grow with the corpus size.
+    The index names are then yielded in completion order.
     """
     analyzers: list[Analyzer] = get_analyzers()
-    docs = read_docs()
 
-    for a in analyzers:
-        index_name = generate_index_name_from_analyzer(a)
+    if isinstance(client, OfflineClient):
+        for a in analyzers:
+            index_name = generate_index_name_from_analyzer(a)
+            client.create_index(index_name, get_analyzer_definition(a), iter_docs())
+            record_generation(client, index_name, get_analyzer_definition(a))
+            yield index_name
+        return
 
-        index = Index(index_name)
-        index.analyzer(a)
+    if streaming:
+        def build(a: Analyzer) -> str:
+            index_name = create_index(a, client)
+            stream_documents(iter_docs(), index_name, client, chunk_size, thread_count)
+            record_generation(client, index_name, get_analyzer_definition(a))
+            return index_name
 
-        # Specify mapping
-        @index.document
-        class Article(Document):
-            title = Text(analyzer=a)
-            summary = Text(analyzer=a)
+        with ThreadPoolExecutor(max_workers=len(analyzers)) as executor:
+            futures = [executor.submit(build, a) for a in analyzers]
+            for future in as_completed(futures):
+                yield future.result()
+        return
 
-        index.delete(ignore=404, using=client)
-        index.create(using=client)
+    docs = read_docs()
 
+    for a in analyzers:
+        index_name = create_index(a, client)
         upload_documents(docs, index_name, client)
+        record_generation(client, index_name, get_analyzer_definition(a))
         yield index_name
 
 
@@ -102,10 +341,11 @@ def get_index_names() -> list[str]:
     return index_names
 
 
-def main():
-    client = Elasticsearch()
+def main(streaming: bool = False, chunk_size: int = 500, thread_count: int = 4,
+         offline: Path = None):
+    client = OfflineClient(offline) if offline else Elasticsearch(connection_class=instrument.InstrumentedConnection)
 
-    for index in create_indices(client):
+    for index in create_indices(client, streaming, chunk_size, thread_count):
         logging.info(f"Index {index} has been created.")
 
 
@@ -113,4 +353,24 @@ if __name__ == "__main__":
     # execute only if run as a script
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
                         level=logging.INFO)
-    main()
+
+    parser = argparse.ArgumentParser(description="Create the CACM indices.")
+    parser.add_argument("--streaming", action="store_true",
+                        help="stream the corpus and build all indices concurrently")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="number of documents per bulk request in streaming mode")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="number of bulk threads per index in streaming mode")
+    parser.add_argument("--offline", type=Path, metavar="DIR",
+                        help="build in-process indices in DIR instead of Elasticsearch")
+    parser.add_argument("--metrics", type=Path, metavar="FILE",
+                        help="write timings, counters and server times to FILE (Prometheus text if it ends with .prom)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve timings, counters and server times on http://127.0.0.1:PORT/metrics, "
+                             "until interrupted once the work is done")
+    args = parser.parse_args()
+
+    instrument.configure(args.metrics, args.metrics_port)
+    main(streaming=args.streaming, chunk_size=args.chunk_size, thread_count=args.threads,
+         offline=args.offline)
+    instrument.finish(args.metrics)
@@ -0,0 +1,75 @@
+"""
+Opt-in instrumentation of the calls to Elasticsearch and the offline indices.
+
+The measures are kept in the shared Registry of common/instrumentation.py:
+timings of the instrumented functions, counters of round trips, bytes,
+documents and queries, and the `took` of the responses of Elasticsearch as
+server time. Every round trip to the cluster goes through
+InstrumentedConnection, which records them.
+"""
+import re
+import sys
+from pathlib import Path
+
+from elasticsearch import Urllib3HttpConnection
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'common'))
+from instrumentation import Registry
+
+
+_TOOK = re.compile(r'"took"\s*:\s*(\d+)')
+
+
+REGISTRY = Registry('lab2')
+"""Registry of the process, used by the functions below"""
+
+timer = REGISTRY.timer
+timed = REGISTRY.timed
+count = REGISTRY.count
+observe_server = REGISTRY.observe_server
+enable = REGISTRY.enable
+configure = REGISTRY.configure
+write = REGISTRY.write
+serve = REGISTRY.serve
+finish = REGISTRY.finish
+
+
+def endpoint(path: str) -> str:
+    """
+    Name of the API called by a request path, e.g. '_msearch' for '/cacm_english/_msearch'.
+    """
+    parts = [part for part in path.split('?')[0].split('/') if part]
+    api = [part for part in parts if part.startswith('_')]
+    return api[0] if api else 'index' if parts else 'root'
+
+
+class InstrumentedConnection(Urllib3HttpConnection):
+    """
+    Connection recording each round trip to the cluster, with its bytes and the `took` of its response.
+
+    Give it to the client with Elasticsearch(connection_class=InstrumentedConnection).
+    """
+
+    def log_request_success(self, method, full_url, path, body, status_code, response, duration):
+        super().log_request_success(method, full_url, path, body, status_code, response, duration)
+        if REGISTRY.enabled:
+            name = endpoint(path)
+            _record_round_trip(name, body, response, duration)
+            took = _TOOK.search(response[:64]) if response else None
+            if took:
+                REGISTRY.observe_server(name, int(took.group(1)) / 1000)
+
+    def log_request_fail(self, method, full_url, path, body, duration, status_code=None, response=None,
+                         exception=None):
+        super().log_request_fail(method, full_url, path, body, duration, status_code, response, exception)
+        if REGISTRY.enabled:
+            name = endpoint(path)
+            _record_round_trip(name, body, response, duration)
+            REGISTRY.count(f"es_failures.{name}")
+
+
+def _record_round_trip(name: str, body, response, duration: float):
+    REGISTRY.count(f"es_round_trips.{name}")
+    REGISTRY.count("es_bytes_sent", len(body) if body else 0)
+    REGISTRY.count("es_bytes_received", len(response.encode()) if isinstance(response, str) else len(response or b''))
+    REGISTRY.observe(f"es_request.{name}", duration)
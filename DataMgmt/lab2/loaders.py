@@ -0,0 +1,221 @@
+"""
+Loaders of the queries, the relevance judgments and the corpus of the lab.
+
+Each text file is parsed once into NumPy arrays saved in CACHE_FOLDER with
+the size, modification time and hash of the file, which later loads check
+before reading the arrays instead of parsing the file again.
+The relevance judgments are kept as CSR arrays (the relevant documents of
+the i-th query are doc_ids[indptr[i]:indptr[i + 1]]) and the corpus as the
+byte offsets of its lines in the memory-mapped ndjson file, so a document is
+only decoded when it is read. All paths are relative to this module, not to
+the working directory.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+
+
+MODULE_FOLDER = Path(__file__).resolve().parent
+QUERIES_PATH = MODULE_FOLDER / 'evaluation' / 'query.txt'
+QRELS_PATH = MODULE_FOLDER / 'evaluation' / 'qrels.txt'
+DOCS_PATH = MODULE_FOLDER / 'data' / 'cacm.v2.ndjson'
+
+CACHE_FOLDER = MODULE_FOLDER / 'loader_cache'
+"""Folder of the parsed arrays, one .npz file per source file"""
+
+QUERY_SEPARATOR = b"\t"
+QREL_SEPARATOR = b";"
+DOC_SEPARATOR = b","
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _save(cache: Path, stat: os.stat_result, digest: str, arrays: dict[str, np.ndarray]):
+    # each writer has its own temporary file, so concurrent loads of a cold cache do not collide
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache.parent, prefix=cache.name, suffix='.tmp', delete=False) as f:
+        np.savez(f, size=np.array(stat.st_size), mtime_ns=np.array(stat.st_mtime_ns), sha256=np.array(digest),
+                 **arrays)
+    os.replace(f.name, cache)
+
+
+def cached_arrays(path: Path, parse: Callable[[bytes], dict[str, np.ndarray]],
+                  cache_folder: Optional[Path] = CACHE_FOLDER) -> dict[str, np.ndarray]:
+    """
+    Arrays parsed from a file, read from the cache while the content of the file does not change.
+
+    The file is only hashed when its size or modification time differ from
+    the ones stored with the arrays, and parsed again when its hash differs
+    too. When only the size or modification time changed, they are updated in
+    the cache so the file is not hashed again. Without cache_folder, the file
+    is always parsed.
+    """
+    if cache_folder is None:
+        return parse(path.read_bytes())
+
+    stat = path.stat()
+    cache = cache_folder / f"{path.name}.npz"
+    digest = None
+    if cache.exists():
+        with np.load(cache) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        stored = {name: arrays.pop(name) for name in ('size', 'mtime_ns', 'sha256')}
+        if (int(stored['size']), int(stored['mtime_ns'])) == (stat.st_size, stat.st_mtime_ns):
+            return arrays
+        digest = file_hash(path)
+        if str(stored['sha256']) == digest:
+            _save(cache, stat, digest, arrays)
+            return arrays
+
+    arrays = parse(path.read_bytes())
+    _save(cache, stat, digest or file_hash(path), arrays)
+    return arrays
+
+
+def _lines(content: bytes) -> list[bytes]:
+    return [line for line in (line.strip() for line in content.splitlines()) if line]
+
+
+def parse_queries(content: bytes) -> dict[str, np.ndarray]:
+    parsed = [line.split(QUERY_SEPARATOR) for line in _lines(content)]
+    return {
+        'query_ids': np.array([int(p[0]) for p in parsed], dtype=np.int64),
+        'texts': np.array([p[1].decode() for p in parsed], dtype=np.str_),
+    }
+
+
+def parse_qrels(content: bytes) -> dict[str, np.ndarray]:
+    parsed = [line.split(QREL_SEPARATOR) for line in _lines(content)]
+    docs = [np.unique(np.array(p[1].split(DOC_SEPARATOR), dtype=np.int64)) for p in parsed]
+    return {
+        'query_ids': np.array([int(p[0]) for p in parsed], dtype=np.int64),
+        'indptr': np.concatenate([[0], np.cumsum([len(d) for d in docs])]).astype(np.int64),
+        'doc_ids': np.concatenate(docs) if docs else np.empty(0, dtype=np.int64),
+    }
+
+
+def parse_doc_offsets(content: bytes) -> dict[str, np.ndarray]:
+    data = np.frombuffer(content, dtype=np.uint8)
+    ends = np.flatnonzero(data == ord('\n'))
+    if len(content) and content[-1:] != b'\n':
+        ends = np.append(ends, len(content))
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    ends = ends.astype(np.int64)
+    keep = [bool(content[s:e].strip()) for s, e in zip(starts.tolist(), ends.tolist())]
+    starts, ends = starts[keep], ends[keep]
+    doc_ids = np.array([json.loads(content[s:e])['_id'] for s, e in zip(starts.tolist(), ends.tolist())],
+                       dtype=np.int64)
+    return {'starts': starts, 'ends': ends, 'doc_ids': doc_ids}
+
+
+def read_queries(path: Path = QUERIES_PATH, cache_folder: Optional[Path] = CACHE_FOLDER) -> dict[int, str]:
+    """
+    Returns a dictionary that contains for each query id the query phrase.
+    """
+    arrays = cached_arrays(path, parse_queries, cache_folder)
+    return dict(zip(arrays['query_ids'].tolist(), arrays['texts'].tolist()))
+
+
+class Qrels:
+    """
+    Relevance judgments in CSR form, the relevant documents of the i-th query
+    of query_ids are doc_ids[indptr[i]:indptr[i + 1]].
+    """
+
+    def __init__(self, query_ids: np.ndarray, indptr: np.ndarray, doc_ids: np.ndarray):
+        self.query_ids = query_ids
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self._positions = {query_id: i for i, query_id in enumerate(query_ids.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.query_ids)
+
+    def relevant(self, query_id: int) -> np.ndarray:
+        """
+        Ids of the documents relevant to a query, empty for an unknown query.
+        """
+        i = self._positions.get(query_id)
+        if i is None:
+            return self.doc_ids[:0]
+        return self.doc_ids[self.indptr[i]:self.indptr[i + 1]]
+
+    def get(self, query_id: int, default=None):
+        """
+        Like dict.get, so the judgments can be given to compute_metrics without building sets.
+        """
+        return self.relevant(query_id) if query_id in self._positions else default
+
+    def to_sets(self) -> dict[int, set[int]]:
+        """
+        The judgments as a dictionary that returns an empty set for an unknown query.
+        """
+        qrels = defaultdict(set)
+        doc_ids = self.doc_ids.tolist()
+        bounds = self.indptr.tolist()
+        for i, query_id in enumerate(self.query_ids.tolist()):
+            qrels[query_id] = set(doc_ids[bounds[i]:bounds[i + 1]])
+        return qrels
+
+
+def load_qrels(path: Path = QRELS_PATH, cache_folder: Optional[Path] = CACHE_FOLDER) -> Qrels:
+    arrays = cached_arrays(path, parse_qrels, cache_folder)
+    return Qrels(arrays['query_ids'], arrays['indptr'], arrays['doc_ids'])
+
+
+def read_qrels(path: Path = QRELS_PATH, cache_folder: Optional[Path] = CACHE_FOLDER) -> dict[int, set[int]]:
+    """
+    Returns a dictionary that contains for each query id the set of relevant document ids.
+    When accessing a unknown query id, the dictionary returns an empty set.
+    """
+    return load_qrels(path, cache_folder).to_sets()
+
+
+class Corpus:
+    """
+    Documents of an ndjson file, memory-mapped and decoded one at a time.
+    """
+
+    def __init__(self, path: Path, starts: np.ndarray, ends: np.ndarray, doc_ids: np.ndarray):
+        self.path = path
+        self.starts = starts
+        self.ends = ends
+        self.doc_ids = doc_ids
+        self._data = np.memmap(path, dtype=np.uint8, mode='r') if path.stat().st_size else np.empty(0, np.uint8)
+        self._positions = None
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __getitem__(self, i: int) -> dict:
+        return json.loads(self._data[self.starts[i]:self.ends[i]].tobytes())
+
+    def __iter__(self) -> Iterator[dict]:
+        for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+            yield json.loads(self._data[start:end].tobytes())
+
+    def get(self, doc_id: int) -> Optional[dict]:
+        """
+        The document with the given id, or None.
+        """
+        if self._positions is None:
+            self._positions = {d: i for i, d in enumerate(self.doc_ids.tolist())}
+        i = self._positions.get(doc_id)
+        return None if i is None else self[i]
+
+
+def load_corpus(path: Path = DOCS_PATH, cache_folder: Optional[Path] = CACHE_FOLDER) -> Corpus:
+    arrays = cached_arrays(path, parse_doc_offsets, cache_folder)
+    return Corpus(path, arrays['starts'], arrays['ends'], arrays['doc_ids'])
@@ -0,0 +1,276 @@
+import itertools
+import json
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Iterator, Optional
+
+import numpy as np
+
+
+RECALL_LEVELS = np.linspace(0.0, 1.0, 11)
+"""The 11 standard recall levels (0.0, 0.1, ..., 1.0)"""
+
+CUTOFFS = (5, 10, 20)
+"""Ranks at which P@k and nDCG@k are computed"""
+
+
+class QueryMetrics:
+    """
+    Metrics of each query of a run: one array per metric, with one row per query of query_ids.
+    """
+
+    def __init__(self, query_ids: list[int], arrays: dict[str, np.ndarray]):
+        self.query_ids = np.asarray(query_ids, dtype=np.int64)
+        self.arrays = {name: np.asarray(values) for name, values in arrays.items()}
+
+    def __getitem__(self, metric: str) -> np.ndarray:
+        return self.arrays[metric]
+
+    def __len__(self) -> int:
+        return len(self.query_ids)
+
+    def __repr__(self) -> str:
+        # kept short, so that printing RankingMetrics only shows the averages
+        return f"QueryMetrics({len(self)} queries)"
+
+    def select(self, query_ids: np.ndarray) -> "QueryMetrics":
+        """
+        The metrics of the given queries, in their order.
+        """
+        position = {query_id: i for i, query_id in enumerate(self.query_ids.tolist())}
+        rows = np.array([position[query_id] for query_id in query_ids], dtype=np.int64)
+        return QueryMetrics(query_ids, {name: values[rows] for name, values in self.arrays.items()})
+
+
+class RankingMetrics(SimpleNamespace):
+    """
+    Simple class to store the metrics of an index.
+
+    The averages are attributes, the metrics of the individual queries are
+    kept in per_query.
+    """
+    index_name: str
+
+    total_retrieved_docs: int = 0
+    """Sum of the number retrieved documents of each query"""
+
+    total_relevant_docs: int = 0
+    """Sum of the number of relevant documents for each query"""
+
+    total_retrieved_relevant_docs: int = 0
+    """Sum of the number of relevant documents retrieved for each query"""
+
+    avg_precision: float = 0.0
+    """Average of the precision of each query"""
+
+    avg_recall: float = 0.0
+    """Average of the recall of each query"""
+
+    f_measure: float = 0.0
+    """F-Measure calculated from avg_precision and avg_recall"""
+
+    mean_average_precision: float = 0.0
+    """Mean of the average precision (AP) of each query"""
+
+    avg_r_precision: float = 0.0
+    """Average of the R-Precision of each query"""
+
+    avg_precision_at_recall_level: list[float] = [0.0] * 11
+    """Average of the precision at the 11 standard recall levels of each query"""
+
+    avg_precision_at_k: dict[int, float] = {}
+    """Average of the precision at each rank of CUTOFFS (P@k) of each query"""
+
+    avg_ndcg_at_k: dict[int, float] = {}
+    """Average of the nDCG at each rank of CUTOFFS of each query"""
+
+    per_query: Optional[QueryMetrics] = None
+    """Metrics of each query, from which the averages are computed"""
+
+
+def _pad(rows: list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pack variable length rows of ids into a (len(rows), max length) matrix.
+
+    Returns the matrix, padded with -1, and the length of each row.
+    """
+    lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    width = int(lengths.max(initial=0))
+    flat = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=int(lengths.sum()))
+    matrix = np.full((len(rows), width), -1, dtype=np.int64)
+    matrix[np.arange(width) < lengths[:, None]] = flat
+    return matrix, lengths
+
+
+def relevance_matrix(results: list[list[int]], qrels: list[set[int]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Build the relevance matrix of a run.
+
+    `results[i]` is the ranked list of documents retrieved for the i-th query
+    and `qrels[i]` the set of documents relevant to it. Cell (i, j) of the
+    returned boolean matrix tells if the document at rank j+1 for query i is
+    relevant. The number of relevant documents of each query is returned too.
+    """
+    docs, _ = _pad(results)
+    relevant, n_relevant = _pad([list(r) for r in qrels])
+
+    # Relevance is looked up for the whole run at once by encoding each
+    # (query, document) pair as a single integer key.
+    base = max(int(docs.max(initial=0)), int(relevant.max(initial=0))) + 1
+    rows = np.arange(len(results), dtype=np.int64)[:, None]
+    retrieved_keys = rows * base + docs
+    relevant_keys = (rows * base + relevant)[relevant >= 0]
+    rel = np.isin(retrieved_keys, relevant_keys) & (docs >= 0)
+    return rel, n_relevant
+
+
+def per_query_metrics(rel: np.ndarray, n_retrieved: np.ndarray, n_relevant: np.ndarray,
+                      cutoffs: tuple[int, ...] = CUTOFFS) -> dict[str, np.ndarray]:
+    """
+    Compute the metrics of every query from a relevance matrix.
+
+    Returns a dictionary of arrays with one value per query (one row per query
+    for the 11-point curve). Queries without relevant documents get 0 for the
+    recall based metrics.
+    """
+    n_queries, depth = rel.shape
+    ranks = np.arange(1, depth + 1)
+    has_relevant = n_relevant > 0
+    safe_relevant = np.maximum(n_relevant, 1)
+
+    hits = np.cumsum(rel, axis=1)
+    precision_at_rank = hits / ranks
+    retrieved_relevant = hits[:, -1] if depth else np.zeros(n_queries, dtype=np.int64)
+
+    def hits_at(k) -> np.ndarray:
+        """Number of relevant documents in the top k of each query"""
+        if depth == 0:
+            return np.zeros(n_queries, dtype=np.int64)
+        idx = np.minimum(k, depth) - 1
+        return np.where(np.asarray(idx) >= 0, hits[np.arange(n_queries), np.maximum(idx, 0)], 0)
+
+    precision = retrieved_relevant / np.maximum(n_retrieved, 1)
+    recall = np.where(has_relevant, retrieved_relevant / safe_relevant, 0.0)
+    average_precision = np.where(has_relevant, (precision_at_rank * rel).sum(axis=1) / safe_relevant, 0.0)
+    r_precision = np.where(has_relevant, hits_at(n_relevant) / safe_relevant, 0.0)
+
+    # Interpolated precision at recall r is the best precision reached at any
+    # rank whose recall is >= r, i.e. a reversed running max over the ranks.
+    precision_at_recall_level = np.zeros((n_queries, len(RECALL_LEVELS)))
+    if depth:
+        interpolated = np.maximum.accumulate(precision_at_rank[:, ::-1], axis=1)[:, ::-1]
+        recall_at_rank = hits / safe_relevant[:, None]
+        reached = recall_at_rank[:, None, :] >= RECALL_LEVELS[None, :, None] - 1e-9
+        first_rank = reached.argmax(axis=2)
+        precision_at_recall_level = np.where(
+            reached.any(axis=2) & has_relevant[:, None],
+            np.take_along_axis(interpolated, first_rank, axis=1),
+            0.0
+        )
+
+    metrics = {
+        "retrieved": n_retrieved,
+        "relevant": n_relevant,
+        "retrieved_relevant": retrieved_relevant,
+        "precision": precision,
+        "recall": recall,
+        "average_precision": average_precision,
+        "r_precision": r_precision,
+        "precision_at_recall_level": precision_at_recall_level,
+    }
+
+    # Binary gains: DCG@k sums 1/log2(rank+1) over relevant ranks, the ideal
+    # DCG puts min(R, k) relevant documents first.
+    discounts = 1.0 / np.log2(np.arange(2, max(depth, max(cutoffs)) + 2))
+    ideal = np.concatenate(([0.0], np.cumsum(discounts)))
+    gains = rel * discounts[:depth]
+    for k in cutoffs:
+        metrics[f"precision_at_{k}"] = hits_at(k) / k
+        idcg = ideal[np.minimum(n_relevant, k)]
+        dcg = gains[:, :k].sum(axis=1)
+        metrics[f"ndcg_at_{k}"] = np.where(idcg > 0, dcg / np.where(idcg > 0, idcg, 1.0), 0.0)
+    return metrics
+
+
+def query_metrics(run: dict[int, list[int]],
+                  qrels: dict[int, set[int]],
+                  cutoffs: tuple[int, ...] = CUTOFFS) -> tuple[list[int], dict[str, np.ndarray]]:
+    """
+    Compute the metrics of each query of a run, i.e. the ranked documents retrieved for each query.
+
+    Returns the query ids and the per_query_metrics() arrays, in the same order.
+    """
+    query_ids = list(run.keys())
+    results = [run[q] for q in query_ids]
+    rel, n_relevant = relevance_matrix(results, [qrels.get(q, set()) for q in query_ids])
+    n_retrieved = np.fromiter(map(len, results), dtype=np.int64, count=len(results))
+    return query_ids, per_query_metrics(rel, n_retrieved, n_relevant, cutoffs)
+
+
+def aggregate_metrics(index_name: str,
+                      query_ids: list[int],
+                      per_query: dict[str, np.ndarray],
+                      cutoffs: tuple[int, ...] = CUTOFFS) -> RankingMetrics:
+    """
+    Average the metrics of each query returned by query_metrics().
+    """
+    m = RankingMetrics()
+    m.index_name = index_name
+    m.per_query = QueryMetrics(query_ids, per_query)
+    if not query_ids:
+        return m
+
+    m.total_retrieved_docs = int(per_query["retrieved"].sum())
+    m.total_relevant_docs = int(per_query["relevant"].sum())
+    m.total_retrieved_relevant_docs = int(per_query["retrieved_relevant"].sum())
+    m.avg_precision = float(per_query["precision"].mean())
+    m.avg_recall = float(per_query["recall"].mean())
+    if m.avg_precision + m.avg_recall > 0:
+        m.f_measure = (2 * m.avg_precision * m.avg_recall) / (m.avg_precision + m.avg_recall)
+    m.mean_average_precision = float(per_query["average_precision"].mean())
+    m.avg_r_precision = float(per_query["r_precision"].mean())
+    m.avg_precision_at_recall_level = per_query["precision_at_recall_level"].mean(axis=0).tolist()
+    m.avg_precision_at_k = {k: float(per_query[f"precision_at_{k}"].mean()) for k in cutoffs}
+    m.avg_ndcg_at_k = {k: float(per_query[f"ndcg_at_{k}"].mean()) for k in cutoffs}
+    return m
+
+
+def compute_metrics(index_name: str,
+                    run: dict[int, list[int]],
+                    qrels: dict[int, set[int]],
+                    cutoffs: tuple[int, ...] = CUTOFFS) -> RankingMetrics:
+    """
+    Compute the metrics of a run, i.e. the ranked documents retrieved for each query.
+
+    Every query of the run is taken into account in the averages, including
+    the queries without relevant documents.
+    """
+    query_ids, per_query = query_metrics(run, qrels, cutoffs)
+    return aggregate_metrics(index_name, query_ids, per_query, cutoffs)
+
+
+def query_records(index_name: str,
+                  query_ids: list[int],
+                  per_query: dict[str, np.ndarray]) -> Iterator[dict]:
+    """
+    Yield the metrics of each query returned by query_metrics() as JSON serializable dicts.
+    """
+    columns = {name: values.tolist() for name, values in per_query.items()}
+    for i, query_id in enumerate(query_ids):
+        yield {"run": index_name, "query": query_id, **{name: values[i] for name, values in columns.items()}}
+
+
+def read_query_records(path: Path) -> dict[str, QueryMetrics]:
+    """
+    Read the JSON lines written from query_records(), returns the metrics of each query of each run.
+    """
+    records: dict[str, list[dict]] = {}
+    with path.open() as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records.setdefault(record.pop("run"), []).append(record)
+    return {
+        run: QueryMetrics([r.pop("query") for r in rows], {name: [r[name] for r in rows] for name in rows[0]})
+        for run, rows in records.items()
+    }
@@ -0,0 +1,354 @@
+"""
+In-process stand-in for the Elasticsearch indices of this lab.
+
+The four analyzers of `get_analyzers()` are reimplemented in Python and the
+documents are indexed into an inverted index scored with BM25, like
+Elasticsearch does by default. The postings of each field are stored as flat
+NumPy arrays on disk and memory-mapped when an index is opened.
+"""
+import json
+import math
+import re
+from array import array
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+
+
+Analyze = Callable[[str], list[str]]
+"""Type alias for a function turning a text into its list of terms"""
+
+FIELDS = ("title", "summary")
+"""Fields searched by the multi match query of search()"""
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+ENGLISH_STOP_WORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in",
+    "into", "is", "it", "no", "not", "of", "on", "or", "such", "that", "the",
+    "their", "then", "there", "these", "they", "this", "to", "was", "will", "with",
+])
+"""Lucene's default English stop words, used by the english analyzer"""
+
+# Approximation of the Unicode word boundaries used by the standard tokenizer:
+# numbers keep their separators and words keep inner apostrophes and dots.
+_STANDARD_TOKEN = re.compile(r"\d+(?:[.,]\d+)+|\w+(?:['’.]\w+)*")
+
+
+def standard_tokenizer(text: str) -> list[str]:
+    return _STANDARD_TOKEN.findall(text)
+
+
+def whitespace_tokenizer(text: str) -> list[str]:
+    return text.split()
+
+
+def _remove_possessive(token: str) -> str:
+    if len(token) > 2 and token[-2] in "'’" and token[-1] in "sS":
+        return token[:-2]
+    return token
+
+
+def _is_consonant(word: str, i: int) -> bool:
+    ch = word[i]
+    if ch in "aeiou":
+        return False
+    if ch == "y":
+        return i == 0 or not _is_consonant(word, i - 1)
+    return True
+
+
+def _measure(stem: str) -> int:
+    """Number of vowel-consonant sequences in the stem, m in [C](VC)^m[V]"""
+    m = 0
+    previous_is_vowel = False
+    for i in range(len(stem)):
+        consonant = _is_consonant(stem, i)
+        if consonant and previous_is_vowel:
+            m += 1
+        previous_is_vowel = not consonant
+    return m
+
+
+def _has_vowel(stem: str) -> bool:
+    return any(not _is_consonant(stem, i) for i in range(len(stem)))
+
+
+def _ends_double_consonant(word: str) -> bool:
+    return len(word) >= 2 and word[-1] == word[-2] and _is_consonant(word, len(word) - 1)
+
+
+def _ends_cvc(word: str) -> bool:
+    n = len(word)
+    return (n >= 3 and _is_consonant(word, n - 1) and not _is_consonant(word, n - 2)
+            and _is_consonant(word, n - 3) and word[-1] not in "wxy")
+
+
+_STEP2 = [
+    ("ational", "ate"), ("tional", "tion"), ("enci", "ence"), ("anci", "ance"),
+    ("izer", "ize"), ("bli", "ble"), ("alli", "al"), ("entli", "ent"), ("eli", "e"),
+    ("ousli", "ous"), ("ization", "ize"), ("ation", "ate"), ("ator", "ate"),
+    ("alism", "al"), ("iveness", "ive"), ("fulness", "ful"), ("ousness", "ous"),
+    ("aliti", "al"), ("iviti", "ive"), ("biliti", "ble"), ("logi", "log"),
+]
+_STEP3 = [
+    ("icate", "ic"), ("ative", ""), ("alize", "al"), ("iciti", "ic"),
+    ("ical", "ic"), ("ful", ""), ("ness", ""),
+]
+_STEP4 = [
+    "al", "ance", "ence", "er", "ic", "able", "ible", "ant", "ement", "ment",
+    "ent", "ion", "ou", "ism", "ate", "iti", "ous", "ive", "ize",
+]
+
+
+def _replace_suffix(word: str, rules: list[tuple[str, str]]) -> str:
+    # Only the first matching suffix is considered, as in the reference implementation
+    for suffix, replacement in rules:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            return stem + replacement if _measure(stem) > 0 else word
+    return word
+
+
+def porter_stem(word: str) -> str:
+    """
+    Porter stemming algorithm, as implemented by Lucene's PorterStemFilter.
+    """
+    if len(word) <= 2:
+        return word
+
+    # Step 1a: plurals
+    if word.endswith("sses") or word.endswith("ies"):
+        word = word[:-2]
+    elif word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+
+    # Step 1b: -eed, -ed and -ing
+    if word.endswith("eed"):
+        if _measure(word[:-3]) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ("ed", "ing"):
+            if word.endswith(suffix) and _has_vowel(word[:-len(suffix)]):
+                word = word[:-len(suffix)]
+                if word.endswith(("at", "bl", "iz")):
+                    word += "e"
+                elif _ends_double_consonant(word) and word[-1] not in "lsz":
+                    word = word[:-1]
+                elif _measure(word) == 1 and _ends_cvc(word):
+                    word += "e"
+                break
+
+    # Step 1c: terminal y to i when there is another vowel in the stem
+    if word.endswith("y") and _has_vowel(word[:-1]):
+        word = word[:-1] + "i"
+
+    # Steps 2 and 3: map double suffixes to single ones
+    word = _replace_suffix(word, _STEP2)
+    word = _replace_suffix(word, _STEP3)
+
+    # Step 4: remove suffixes when the measure of the stem is > 1
+    for suffix in _STEP4:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if _measure(stem) > 1 and (suffix != "ion" or stem.endswith(("s", "t"))):
+                word = stem
+            break
+
+    # Step 5: remove a final e and reduce a final double l
+    if word.endswith("e"):
+        m = _measure(word[:-1])
+        if m > 1 or (m == 1 and not _ends_cvc(word[:-1])):
+            word = word[:-1]
+    if word.endswith("ll") and _measure(word) > 1:
+        word = word[:-1]
+
+    return word
+
+
+def read_stop_words(path: Path) -> frozenset[str]:
+    # like Elasticsearch resolves it against its config folder, a relative path is
+    # resolved against the folder of the lab rather than the working directory
+    if not path.is_absolute():
+        path = Path(__file__).resolve().parent / path
+    with path.open() as f:
+        return frozenset(line.strip() for line in f if line.strip())
+
+
+def make_analyzer(definition: dict) -> Analyze:
+    """
+    Build the analysis function matching an Elasticsearch analyzer definition.
+
+    Supported types are the builtin standard, whitespace and english analyzers,
+    the latter with an optional `stopwords_path`.
+    """
+    analyzer_type = definition["type"]
+
+    if analyzer_type == "standard":
+        return lambda text: [t.lower() for t in standard_tokenizer(text)]
+
+    if analyzer_type == "whitespace":
+        return whitespace_tokenizer
+
+    if analyzer_type == "english":
+        if "stopwords_path" in definition:
+            stop_words = read_stop_words(Path(definition["stopwords_path"]))
+        else:
+            stop_words = ENGLISH_STOP_WORDS
+
+        def analyze(text: str) -> list[str]:
+            tokens = (_remove_possessive(t).lower() for t in standard_tokenizer(text))
+            return [porter_stem(t) for t in tokens if t not in stop_words]
+        return analyze
+
+    raise ValueError(f"Unsupported analyzer type: {analyzer_type}")
+
+
+class InvertedIndex:
+    """
+    BM25 inverted index over the title and summary fields of the documents.
+
+    For each field, the postings of term `t` are the slice
+    `offsets[t]:offsets[t + 1]` of the `docs` (internal document numbers) and
+    `tfs` (term frequencies) arrays. Internal document numbers index the
+    `doc_ids` array, which holds the ids of the corpus.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with (path / "meta.json").open() as f:
+            meta = json.load(f)
+
+        self.analyze = make_analyzer(meta["analyzer"])
+        self.doc_ids = np.load(path / "doc_ids.npy", mmap_mode="r")
+        self.fields = {}
+        for field, stats in meta["fields"].items():
+            lengths = np.load(path / f"{field}.lengths.npy", mmap_mode="r")
+            avg_length = stats["sum_length"] / stats["doc_count"] if stats["doc_count"] else 1.0
+            self.fields[field] = {
+                "vocabulary": {term: i for i, term in enumerate(stats["terms"])},
+                "doc_count": stats["doc_count"],
+                "offsets": np.load(path / f"{field}.offsets.npy", mmap_mode="r"),
+                "docs": np.load(path / f"{field}.docs.npy", mmap_mode="r"),
+                "tfs": np.load(path / f"{field}.tfs.npy", mmap_mode="r"),
+                # Length normalization of the BM25 term frequency, per document
+                "norms": BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_length),
+            }
+
+    @classmethod
+    def build(cls, path: Path, definition: dict, docs: Iterable[dict]) -> "InvertedIndex":
+        """
+        Index the documents with the given analyzer definition and store the index in `path`.
+        """
+        analyze = make_analyzer(definition)
+        doc_ids = array("q")
+        postings = {field: {} for field in FIELDS}
+        lengths = {field: array("f") for field in FIELDS}
+        doc_counts = dict.fromkeys(FIELDS, 0)
+
+        for n, doc in enumerate(docs):
+            doc_ids.append(int(doc["_id"]))
+            for field in FIELDS:
+                terms = analyze(doc[field]) if doc.get(field) else []
+                lengths[field].append(len(terms))
+                if terms:
+                    doc_counts[field] += 1
+                frequencies = {}
+                for term in terms:
+                    frequencies[term] = frequencies.get(term, 0) + 1
+                for term, tf in frequencies.items():
+                    term_postings = postings[field].setdefault(term, (array("i"), array("i")))
+                    term_postings[0].append(n)
+                    term_postings[1].append(tf)
+
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "doc_ids.npy", np.frombuffer(doc_ids, dtype=np.int64))
+        meta = {"analyzer": definition, "fields": {}}
+        for field in FIELDS:
+            terms = sorted(postings[field])
+            sizes = np.fromiter((len(postings[field][t][0]) for t in terms), dtype=np.int64, count=len(terms))
+            offsets = np.concatenate(([0], np.cumsum(sizes)))
+            docs_array = np.empty(offsets[-1], dtype=np.int32)
+            tfs_array = np.empty(offsets[-1], dtype=np.int32)
+            for i, term in enumerate(terms):
+                docs_array[offsets[i]:offsets[i + 1]] = np.frombuffer(postings[field][term][0], dtype=np.int32)
+                tfs_array[offsets[i]:offsets[i + 1]] = np.frombuffer(postings[field][term][1], dtype=np.int32)
+
+            np.save(path / f"{field}.offsets.npy", offsets)
+            np.save(path / f"{field}.docs.npy", docs_array)
+            np.save(path / f"{field}.tfs.npy", tfs_array)
+            np.save(path / f"{field}.lengths.npy", np.frombuffer(lengths[field], dtype=np.float32))
+            meta["fields"][field] = {
+                "terms": terms,
+                "doc_count": doc_counts[field],
+                "sum_length": float(sum(lengths[field])),
+            }
+
+        with (path / "meta.json").open("w") as f:
+            json.dump(meta, f)
+        return cls(path)
+
+    def _score_field(self, field: str, terms: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        f = self.fields[field]
+        scores = np.zeros(len(self.doc_ids), dtype=np.float64)
+        matched = np.zeros(len(self.doc_ids), dtype=bool)
+        for term in terms:
+            t = f["vocabulary"].get(term)
+            if t is None:
+                continue
+            start, end = f["offsets"][t], f["offsets"][t + 1]
+            docs = f["docs"][start:end]
+            tfs = f["tfs"][start:end]
+            df = end - start
+            idf = math.log(1 + (f["doc_count"] - df + 0.5) / (df + 0.5))
+            scores[docs] += idf * tfs / (tfs + f["norms"][docs])
+            matched[docs] = True
+        return scores, matched
+
+    def search(self, query: str, k: Optional[int] = 10) -> list[tuple[int, float]]:
+        """
+        Return the k best (document id, score) pairs of a multi match query on
+        all the fields, or all the matching documents if k is None.
+
+        Like a best_fields multi match query, the score of a document is the
+        best score of its fields. Ties are broken by indexing order.
+        """
+        terms = self.analyze(query)
+        scores = np.zeros(len(self.doc_ids), dtype=np.float64)
+        matched = np.zeros(len(self.doc_ids), dtype=bool)
+        for field in self.fields:
+            field_scores, field_matched = self._score_field(field, terms)
+            np.maximum(scores, field_scores, out=scores)
+            matched |= field_matched
+
+        candidates = np.flatnonzero(matched)
+        best = candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+        return [(int(self.doc_ids[n]), float(scores[n])) for n in best]
+
+
+class OfflineClient:
+    """
+    Stand-in for the Elasticsearch client, serving the indices stored in `root`.
+
+    Each index is a directory of `root` named after the index, opened on first use.
+    """
+
+    def __init__(self, root: Path = Path("offline")):
+        self.root = root
+        self._indices: dict[str, InvertedIndex] = {}
+
+    def create_index(self, index_name: str, definition: dict, docs: Iterable[dict]):
+        self._indices[index_name] = InvertedIndex.build(self.root / index_name, definition, docs)
+
+    def get_index(self, index_name: str) -> InvertedIndex:
+        if index_name not in self._indices:
+            self._indices[index_name] = InvertedIndex(self.root / index_name)
+        return self._indices[index_name]
+
+    def iter_search(self, query: str, index_name: str, k: Optional[int] = 10) -> Iterator[tuple[int, float]]:
+        yield from self.get_index(index_name).search(query, k)
+
+    def search(self, query: str, index_name: str, k: Optional[int] = 10) -> list[int]:
+        return [doc_id for doc_id, _ in self.get_index(index_name).search(query, k)]
@@ -0,0 +1,129 @@
+#!/bin/env python
+"""
+Paired significance tests between the per-query metrics of two runs.
+
+The runs are read from the per-query JSON lines written by evaluate.py, so
+comparing two analyzers does not need to search again. The resamples are
+drawn as matrices and evaluated with one matrix product or fancy index per
+block of resamples.
+"""
+import argparse
+import logging
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+from metrics import QueryMetrics, read_query_records
+
+
+BLOCK_SIZE = 1000
+"""Number of resamples evaluated at once, bounds the memory to BLOCK_SIZE x number of queries"""
+
+
+def paired_differences(a: QueryMetrics, b: QueryMetrics, metric: str) -> np.ndarray:
+    """
+    Difference of a metric between two runs for each query they both have.
+    """
+    common = np.intersect1d(a.query_ids, b.query_ids)
+    return a.select(common)[metric].astype(np.float64) - b.select(common)[metric].astype(np.float64)
+
+
+def randomization_test(differences: np.ndarray, resamples: int = 10000, seed: int = 0) -> float:
+    """
+    Two-sided p-value of a paired randomization test of the mean difference.
+
+    Under the null hypothesis, the two runs are exchangeable for each query,
+    so each resample flips the sign of each difference at random.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(differences)
+    observed = abs(differences.mean())
+    extreme = 0
+    for start in range(0, resamples, BLOCK_SIZE):
+        signs = rng.choice(np.array([-1.0, 1.0]), size=(min(BLOCK_SIZE, resamples - start), n))
+        extreme += int((np.abs(signs @ differences) / n >= observed - 1e-12).sum())
+    return (extreme + 1) / (resamples + 1)
+
+
+def bootstrap_test(differences: np.ndarray, resamples: int = 10000, seed: int = 0,
+                   confidence: float = 0.95) -> tuple[float, tuple[float, float]]:
+    """
+    Two-sided p-value of a paired bootstrap test of the mean difference, and
+    the percentile confidence interval of the mean difference.
+
+    Both come from the same resampled means: the p-value inverts the
+    percentile interval, it is the smallest 1 - confidence whose interval
+    excludes 0, so the interval excludes 0 exactly when p < 1 - confidence.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(differences)
+    means = np.empty(resamples)
+    for start in range(0, resamples, BLOCK_SIZE):
+        size = min(BLOCK_SIZE, resamples - start)
+        means[start:start + size] = differences[rng.integers(0, n, size=(size, n))].mean(axis=1)
+    p = min(1.0, 2 * min((means <= 0).mean(), (means >= 0).mean()))
+    # inverse of the empirical distribution: the smallest mean with a share >= q of means at or below it
+    alpha = (1 - confidence) / 2
+    means.sort()
+    low, high = (means[max(int(np.ceil(q * resamples)) - 1, 0)] for q in (alpha, 1 - alpha))
+    return float(p), (float(low), float(high))
+
+
+def compare(a: QueryMetrics, b: QueryMetrics, metric: str = 'average_precision',
+            resamples: int = 10000, seed: int = 0, names: tuple[str, str] = ('a', 'b')) -> SimpleNamespace:
+    """
+    Compare a metric of two runs on their common queries with both tests.
+
+    names are the names of the runs, used in the messages.
+    """
+    common = np.intersect1d(a.query_ids, b.query_ids)
+    if len(common) == 0:
+        raise ValueError(f"Runs {names[0]} and {names[1]} have no query in common")
+    dropped = len(a.query_ids) + len(b.query_ids) - 2 * len(common)
+    if dropped:
+        logging.warning(f"Comparing {names[0]} and {names[1]} on their {len(common)} common queries, "
+                        f"{len(a.query_ids) - len(common)} queries of {names[0]} and "
+                        f"{len(b.query_ids) - len(common)} of {names[1]} are left out")
+    differences = paired_differences(a, b, metric)
+    bootstrap_p, interval = bootstrap_test(differences, resamples, seed)
+    return SimpleNamespace(
+        metric=metric,
+        queries=len(differences),
+        mean_a=float(a.select(common)[metric].mean()),
+        mean_b=float(b.select(common)[metric].mean()),
+        mean_difference=float(differences.mean()),
+        wins=int((differences > 0).sum()),
+        losses=int((differences < 0).sum()),
+        randomization_p=randomization_test(differences, resamples, seed),
+        bootstrap_p=bootstrap_p,
+        bootstrap_interval=interval,
+    )
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
+                        level=logging.WARN)
+
+    parser = argparse.ArgumentParser(description="Test whether a run is significantly better than another one.")
+    parser.add_argument("run_a", help="name of the first run, e.g. cacm_english_stop")
+    parser.add_argument("run_b", help="name of the second run, e.g. cacm_english")
+    parser.add_argument("--per-query", type=Path, default=Path("per_query.jsonl"), metavar="FILE",
+                        help="per-query metrics written by evaluate.py")
+    parser.add_argument("--metric", action="append", dest="metrics", metavar="NAME",
+                        help="metric to compare, can be repeated (average_precision by default)")
+    parser.add_argument("--resamples", type=int, default=10000,
+                        help="number of randomization and bootstrap resamples")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    runs = read_query_records(args.per_query)
+    for metric in args.metrics or ['average_precision']:
+        result = compare(runs[args.run_a], runs[args.run_b], metric, args.resamples, args.seed,
+                         (args.run_a, args.run_b))
+        print(f"{metric}: {args.run_a} {result.mean_a:.4f} vs {args.run_b} {result.mean_b:.4f} "
+              f"over {result.queries} queries, difference {result.mean_difference:+.4f} "
+              f"({result.wins} wins, {result.losses} losses)")
+        print(f"  randomization p = {result.randomization_p:.4f}, bootstrap p = {result.bootstrap_p:.4f}, "
+              f"95% interval [{result.bootstrap_interval[0]:+.4f}, {result.bootstrap_interval[1]:+.4f}]")
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from neo4j import AsyncGraphDatabase
+import pandas as pd
+
+from display import (CITIES_WITHIN_HOPS_QUERY, MAPS, MINST_QUERY, NETWORK_QUERY, SHORTEST_PATH_QUERY,
+                     SHORTEST_PATHS, network_from_records, render_map)
+from index import (ADD_COST_QUERY, CITY_CONSTRAINT_QUERY, CREATE_GRAPH_QUERY, CREATE_MINST_QUERY,
+                   DELETE_MINST_QUERY, DROP_GRAPH_QUERY, MERGE_CITIES_QUERY, MERGE_LINES_QUERY, PROJECTIONS, batches)
+import instrument
+
+
+# asyncio mode of GenerateTrainNetwork and DisplayTrainNetwork: one async driver
+# is shared by all the callers and its pool serves the transactions of the
+# independent steps concurrently instead of one after another
+
+# connection pool of the async driver: enough connections for the concurrent
+# transactions of many users, a caller waits at most connection_acquisition_timeout
+# for one, idle connections are checked before being reused and all of them are
+# renewed before a server or a proxy closes them
+POOL_CONFIG = {
+    'max_connection_pool_size': 50,
+    'connection_acquisition_timeout': 30,
+    'max_connection_lifetime': 30 * 60,
+    'liveness_check_timeout': 60,
+    'keep_alive': True,
+}
+
+
+def async_driver(uri, **pool_config):
+    return AsyncGraphDatabase.driver(uri, **{**POOL_CONFIG, **pool_config})
+
+
+# run a query in a transaction and read all its records before the transaction ends
+async def _run(tx, query, **parameters):
+    result = await tx.run(query, **parameters)
+    return [record async for record in result]
+
+
+async def _write(driver, query, **parameters):
+    async with driver.session() as session:
+        return await session.execute_write(_run, query, **parameters)
+
+
+async def _read(driver, query, **parameters):
+    async with driver.session() as session:
+        return await session.execute_read(_run, query, **parameters)
+
+
+class AsyncGenerateTrainNetwork:
+
+    # concurrency bounds the write transactions in flight: batches of lines lock
+    # the cities at both ends, so more concurrent batches mostly add deadlocks,
+    # which the driver retries
+    def __init__(self, uri, batch_size=1000, concurrency=4, **pool_config):
+        self.driver = async_driver(uri, **pool_config)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+    async def close(self):
+        await self.driver.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _write_batches(self, query, rows):
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def write(batch):
+            async with limit:
+                await _write(self.driver, query, rows=batch)
+        await asyncio.gather(*(write(batch) for batch in batches(rows, self.batch_size)))
+
+    async def create_constraints(self):
+        await _write(self.driver, CITY_CONSTRAINT_QUERY)
+
+    async def create_cities(self, path='data/cities.csv'):
+        await self._write_batches(MERGE_CITIES_QUERY, pd.read_csv(path, sep=';').to_dict('records'))
+
+    async def create_lines(self, path='data/lines.csv'):
+        await self._write_batches(MERGE_LINES_QUERY, pd.read_csv(path, sep=';').to_dict('records'))
+
+    async def create_graph(self, graph):
+        await _write(self.driver, DROP_GRAPH_QUERY, graph=graph)
+        records = await _write(self.driver, CREATE_GRAPH_QUERY, graph=graph, weight=PROJECTIONS[graph])
+        instrument.observe_gds(graph, records[0] if records else None)
+
+    # the cost of the lines is only used by the spanning tree
+    async def add_cost_property(self):
+        await _write(self.driver, ADD_COST_QUERY)
+
+    async def create_minst(self):
+        await _write(self.driver, DELETE_MINST_QUERY)
+        records = await _write(self.driver, CREATE_MINST_QUERY)
+        instrument.observe_gds('minst', records[0] if records else None)
+
+    # same steps as index.py: the cost is written on every line before anything
+    # reads them, then the km and time projections, which only read the lines,
+    # and the spanning tree, which only writes MINST relationships, are created concurrently
+    async def create(self, cities_path='data/cities.csv', lines_path='data/lines.csv'):
+        with instrument.timer('async.create'):
+            await self.create_constraints()
+            await self.create_cities(cities_path)
+            await self.create_lines(lines_path)
+            await self.add_cost_property()
+            await asyncio.gather(*(self.create_graph(graph) for graph in PROJECTIONS), self.create_minst())
+
+
+class AsyncDisplayTrainNetwork:
+
+    def __init__(self, uri, **pool_config):
+        self.driver = async_driver(uri, **pool_config)
+        self._snapshot = None
+
+    async def close(self):
+        await self.driver.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # the data of all the maps, fetched once: concurrent callers wait for the
+    # same fetch, which is started again if it failed
+    async def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = asyncio.ensure_future(self._fetch_snapshot())
+        task = self._snapshot
+        try:
+            return await task
+        except Exception:
+            if self._snapshot is task:
+                self._snapshot = None
+            raise
+
+    # each query of the snapshot runs in its own read transaction, all of them at once
+    async def _fetch_snapshot(self):
+        with instrument.timer('async.snapshot'):
+            network, city_requests, minst, *paths = await asyncio.gather(
+                _read(self.driver, NETWORK_QUERY),
+                self.cities_within_hops('Luzern', 4, 100000),
+                _read(self.driver, MINST_QUERY),
+                *(_read(self.driver, SHORTEST_PATH_QUERY, source=source, target=target, graph=graph, weight=weight)
+                  for source, target, graph, weight in SHORTEST_PATHS.values()),
+            )
+        snapshot = {}
+        snapshot['cities'], snapshot['lines'] = network_from_records(network)
+        snapshot['city_requests'] = city_requests
+        for key, records in zip(SHORTEST_PATHS, paths):
+            snapshot[key] = records[0]['nodeNames'] if records else []
+        snapshot['minst'] = [(record['c1'], record['c2']) for record in minst]
+        return snapshot
+
+    async def cities_within_hops(self, name, max_hops, min_population=0):
+        records = await _read(self.driver, CITIES_WITHIN_HOPS_QUERY,
+                              name=name, max_hops=max_hops, min_population=min_population)
+        return [record['name'] for record in records]
+
+    # render the given maps without blocking the event loop, in the threads of the
+    # default executor or in the given executor, e.g. a ProcessPoolExecutor
+    async def render(self, filenames=tuple(MAPS), executor=None, out_dir='out', compact=False, cluster=False):
+        snapshot = await self.snapshot()
+        loop = asyncio.get_running_loop()
+        with instrument.timer('async.render'):
+            return await asyncio.gather(*(
+                loop.run_in_executor(executor, render_map, snapshot, filename, out_dir, compact, cluster)
+                for filename in filenames
+            ))
+
+
+async def main(args):
+    pool_config = {'max_connection_pool_size': args.pool_size}
+    if args.command == 'generate':
+        async with AsyncGenerateTrainNetwork(args.uri, args.batch_size, args.concurrency,
+                                             **pool_config) as generate_train_network:
+            await generate_train_network.create()
+    else:
+        async with AsyncDisplayTrainNetwork(args.uri, **pool_config) as display_train_network:
+            if args.workers > 1:
+                with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                    await display_train_network.render(executor=executor, compact=args.compact, cluster=args.cluster)
+            else:
+                await display_train_network.render(compact=args.compact, cluster=args.cluster)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load or display the train network with the async Neo4j driver.")
+    parser.add_argument("command", choices=["generate", "display"],
+                        help="load the network like index.py or render the maps like display.py")
+    parser.add_argument("--uri", default="neo4j://localhost:7687")
+    parser.add_argument("--pool-size", type=int, default=POOL_CONFIG['max_connection_pool_size'],
+                        help="maximum number of connections of the driver")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="number of cities or lines created per transaction")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="number of batches written at the same time")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes rendering the maps")
+    parser.add_argument("--compact", action="store_true",
+                        help="draw cities and lines as single GeoJSON layers")
+    parser.add_argument("--cluster", action="store_true",
+                        help="cluster the cities in compact mode")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write timings and GDS times to FILE (Prometheus text if it ends with .prom)")
+    args = parser.parse_args()
+
+    instrument.configure(args.metrics)
+    asyncio.run(main(args))
+    instrument.finish(args.metrics)
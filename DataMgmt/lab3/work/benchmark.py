@@ -0,0 +1,118 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from neo4j import GraphDatabase
+
+from display import DisplayTrainNetwork
+from graph import TrainNetwork
+
+
+# random network of n_cities placed in Switzerland, each linked to its `degree` nearest cities
+def synthetic_network(n_cities, degree=4, seed=0):
+    rng = np.random.default_rng(seed)
+    cities = pd.DataFrame({
+        'name': [f'City{i}' for i in range(n_cities)],
+        'latitude': rng.uniform(45.8, 47.8, n_cities),
+        'longitude': rng.uniform(6.0, 10.5, n_cities),
+        'population': rng.integers(1000, 400000, n_cities),
+    })
+    points = cities[['latitude', 'longitude']].to_numpy()
+    pairs = set()
+    for i in range(n_cities):
+        nearest = np.argsort(((points - points[i]) ** 2).sum(axis=1))[1:degree + 1]
+        pairs.update(tuple(sorted((i, int(j)))) for j in nearest)
+    lines = pd.DataFrame([
+        {'city1': f'City{a}', 'city2': f'City{b}', 'km': 10, 'time': 10, 'nbTracks': 2}
+        for a, b in sorted(pairs)
+    ])
+    return TrainNetwork(cities, lines)
+
+
+# number of paths of 1 to max_hops lines ending at the city, i.e. the rows
+# (c1)-[:Line*1..max_hops]->(c2) enumerates before any DISTINCT. Cypher does not
+# use a relationship twice in a path, so these are trails: a path may go back along
+# a line through its relationship of the other direction, but never through the same
+# one. Each directed relationship is an entry of the CSR arrays of the network.
+# The trails are enumerated, so the count stops at limit and is then None.
+def count_trails(network, name, max_hops, limit=10 ** 7):
+    indptr, targets = network.indptr.tolist(), network.targets.tolist()
+    used = set()
+    total = 0
+
+    def visit(u, hops):
+        nonlocal total
+        for e in range(indptr[u], indptr[u + 1]):
+            if e in used:
+                continue
+            total += 1
+            if total > limit:
+                return False
+            if hops > 1:
+                used.add(e)
+                complete = visit(targets[e], hops - 1)
+                used.discard(e)
+                if not complete:
+                    return False
+        return True
+
+    return total if visit(network.index[name], max_hops) else None
+
+
+def timed(function, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        latencies.append(time.perf_counter() - start)
+    return result, np.median(latencies) * 1000
+
+
+# print the latency of the reachability query for growing hop limits
+def benchmark_reachability(network, name, max_hops, min_population, repeat, driver=None):
+    print(f"{'hops':>4} {'cities':>7} {'trails':>14} {'bfs ms':>9}" + (f" {'apoc ms':>9} {'paths ms':>9}" if driver else ""))
+    for hops in range(1, max_hops + 1):
+        cities, bfs_ms = timed(lambda: network.cities_within_hops(name, hops, min_population), repeat)
+        trails = count_trails(network, name, hops)
+        trails = f">{10 ** 7:.0e}" if trails is None else trails
+        row = f"{hops:>4} {len(cities):>7} {trails:>14} {bfs_ms:>9.3f}"
+        if driver is not None:
+            with driver.session() as session:
+                _, apoc_ms = timed(lambda: session.execute_read(
+                    DisplayTrainNetwork._cities_within_hops, name, hops, min_population), repeat)
+                query = (
+                    """
+                    MATCH (c1:City)-[:Line*1..%d]->(c2:City {name: $name})
+                    WHERE c1.population > $min_population
+                    RETURN c1.name AS name
+                    """ % hops
+                )
+                _, paths_ms = timed(lambda: session.run(query, name=name, min_population=min_population).consume(), repeat)
+            row += f" {apoc_ms:>9.3f} {paths_ms:>9.3f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency of the 'cities within N hops' query.")
+    parser.add_argument("--city", default="Luzern")
+    parser.add_argument("--max-hops", type=int, default=8)
+    parser.add_argument("--min-population", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--synthetic", type=int, metavar="N",
+                        help="use a random network of N cities instead of the CSV files")
+    parser.add_argument("--neo4j", metavar="URI",
+                        help="also time the APOC and path enumerating queries on this database")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        network = synthetic_network(args.synthetic)
+        city = 'City0'
+    else:
+        network = TrainNetwork.from_csv()
+        city = args.city
+
+    driver = GraphDatabase.driver(args.neo4j) if args.neo4j else None
+    benchmark_reachability(network, city, args.max_hops, args.min_population, args.repeat, driver)
+    if driver is not None:
+        driver.close()
@@ -1,5 +1,16 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
 from neo4j import GraphDatabase
 import folium
+from folium.plugins import FastMarkerCluster
+
+from graph import TrainNetwork
+import instrument
+from routes import RouteTable
+
+
+center_switzerland = [46.800663464, 8.222665776]
 
 
 # display city on the folium map
@@ -26,217 +37,300 @@ def display_polyline_on_map(m, locations, popup=None, color="#3186cc", weight=2.
     ).add_to(m)
 
 
+# display all the cities as a single GeoJSON layer instead of one folium object per city
+# cities: list of (name, latitude, longitude), coordinates are rounded to precision decimals
+# (5 decimals is about 1 m), cluster groups nearby cities into clusters at low zoom levels
+def display_cities_layer(m, cities, precision=5, cluster=False, radius=1000, color="#3186cc"):
+    if cluster:
+        FastMarkerCluster(
+            data=[[round(lat, precision), round(long, precision), name] for name, lat, long in cities],
+            callback=(
+                """
+                function (row) {
+                    var circle = L.circle(new L.LatLng(row[0], row[1]),
+                        {radius: %d, color: '%s', fill: true, fillOpacity: 0.8});
+                    circle.bindPopup(row[2]);
+                    return circle;
+                };
+                """ % (radius, color)
+            )
+        ).add_to(m)
+        return
+
+    features = [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [round(long, precision), round(lat, precision)]},
+            'properties': {'name': name},
+        }
+        for name, lat, long in cities
+    ]
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        marker=folium.Circle(radius=radius, color=color, fill=True, fill_opacity=0.8),
+        popup=folium.GeoJsonPopup(fields=['name'], labels=False),
+    ).add_to(m)
+
+
+# display all the lines as a single MultiLineString GeoJSON layer
+# lines: list of lines, each a list of points (latitude, longitude)
+def display_lines_layer(m, lines, precision=5, color="#3186cc", weight=2.0):
+    coordinates = [[[round(long, precision), round(lat, precision)] for lat, long in line] for line in lines]
+    folium.GeoJson(
+        {'type': 'Feature', 'geometry': {'type': 'MultiLineString', 'coordinates': coordinates}, 'properties': {}},
+        style_function=lambda feature: {'color': color, 'weight': weight, 'opacity': 1},
+    ).add_to(m)
+
+
+# A snapshot holds everything the maps need, fetched once:
+#   cities: {name: (latitude, longitude)}
+#   lines: [(line id, city1, city2)], one entry per physical line
+#   city_requests: [city names]
+#   path_km, path_time: [city names] of the shortest paths from Geneve to Chur
+#   minst: [(city1, city2)] edges of the minimum spanning tree
+# Layers draw one part of a snapshot on a map, either with one folium object
+# per city or line, or in compact mode with one GeoJSON layer per part.
+
+def draw_cities(m, snapshot, names=None, compact=False, cluster=False):
+    names = snapshot['cities'] if names is None else names
+    if compact:
+        display_cities_layer(m, [(name, *snapshot['cities'][name]) for name in names], cluster=cluster)
+        return
+    for name in names:
+        latitude, longitude = snapshot['cities'][name]
+        display_city_on_map(m=m, popup=name, latitude=latitude, longitude=longitude)
+
+
+def draw_edges(m, snapshot, edges, color="#3186cc", compact=False):
+    locations = [[snapshot['cities'][c1], snapshot['cities'][c2]] for c1, c2 in edges]
+    if compact:
+        display_lines_layer(m, locations, color=color)
+        return
+    for line in locations:
+        display_polyline_on_map(m=m, locations=line, color=color)
+
+
+def draw_path(m, snapshot, path, compact=False, cluster=False):
+    draw_cities(m, snapshot, path, compact=compact, cluster=cluster)
+    draw_edges(m, snapshot, zip(path, path[1:]), compact=compact)
+
+
+LAYERS = {
+    'cities': lambda m, s, **options: draw_cities(m, s, **options),
+    'lines': lambda m, s, compact, **options: draw_edges(m, s, [(c1, c2) for _, c1, c2 in s['lines']], compact=compact),
+    'city_requests': lambda m, s, **options: draw_cities(m, s, s['city_requests'], **options),
+    'path_km': lambda m, s, **options: draw_path(m, s, s['path_km'], **options),
+    'path_time': lambda m, s, **options: draw_path(m, s, s['path_time'], **options),
+    'minst': lambda m, s, compact, **options: draw_edges(m, s, s['minst'], color='#d11b1b', compact=compact),
+}
+
+MAPS = {
+    '1.html': ['cities'],
+    '2.1.html': ['cities', 'lines'],
+    '2.2.html': ['city_requests'],
+    '2.3.1.html': ['path_km'],
+    '2.3.2.html': ['path_time'],
+    '2.4.html': ['cities', 'lines', 'minst'],
+}
+"""Layers of each output map"""
+
+
+# render one of the MAPS from a snapshot and save it in out_dir
+def render_map(snapshot, filename, out_dir='out', compact=False, cluster=False):
+    m = folium.Map(location=center_switzerland, zoom_start=8)
+    for layer in MAPS[filename]:
+        LAYERS[layer](m, snapshot, compact=compact, cluster=cluster)
+    m.save(f'{out_dir}/{filename}')
+    return filename
+
+
+# queries of the snapshot, shared by DisplayTrainNetwork and aio.AsyncDisplayTrainNetwork
+
+# each line is stored as two relationships, only the one going to the
+# city with the greatest name is kept
+NETWORK_QUERY = (
+    """
+    MATCH (c1:City)
+    OPTIONAL MATCH (c1)-[l:Line]->(c2:City)
+    WHERE c1.name < c2.name
+    RETURN c1.name AS name, c1.latitude AS latitude, c1.longitude AS longitude,
+           collect([id(l), c2.name]) AS lines
+    """
+)
+
+SHORTEST_PATH_QUERY = (
+    """
+    MATCH (source:City {name: $source}), (target:City {name: $target})
+    CALL gds.shortestPath.dijkstra.stream($graph, {
+        sourceNode: source,
+        targetNode: target,
+        relationshipWeightProperty: $weight
+    })
+    YIELD nodeIds
+    RETURN [nodeId IN nodeIds | gds.util.asNode(nodeId).name] AS nodeNames
+    """
+)
+
+# every MINST relationship belongs to the tree written from Bern
+MINST_QUERY = (
+    """
+    MATCH (c1:City)-[:MINST]->(c2:City)
+    RETURN c1.name AS c1, c2.name AS c2
+    """
+)
+
+# subgraphNodes expands breadth first and visits each node once, instead
+# of enumerating every path like (c1)-[:Line*1..N]->(c2) does
+CITIES_WITHIN_HOPS_QUERY = (
+    """
+    MATCH (target:City {name: $name})
+    CALL apoc.path.subgraphNodes(target, {
+        relationshipFilter: '<Line',
+        minLevel: 1,
+        maxLevel: $max_hops
+    })
+    YIELD node
+    WITH node
+    WHERE node.population > $min_population
+    RETURN node.name AS name
+    """
+)
+
+# the shortest paths of the maps, with the projection they are computed on
+SHORTEST_PATHS = {'path_km': ('Geneve', 'Chur', 'lineKM', 'km'), 'path_time': ('Geneve', 'Chur', 'lineTime', 'time')}
+
+
+# cities and lines of the snapshot from the records of NETWORK_QUERY
+def network_from_records(records):
+    cities, lines = {}, []
+    for record in records:
+        cities[record['name']] = (record['latitude'], record['longitude'])
+        for line_id, target in record['lines']:
+            if line_id is not None:
+                lines.append((line_id, record['name'], target))
+    return cities, lines
+
+
 class DisplayTrainNetwork:
 
-    def __init__(self, uri):
-        self.driver = GraphDatabase.driver(uri)
+    # backend 'neo4j' queries the database at uri, backend 'local' computes
+    # everything in-process from the CSV files with graph.TrainNetwork and
+    # answers shortest paths from the precomputed routes.RouteTable
+    def __init__(self, uri=None, backend='neo4j'):
+        self.driver = None
+        self.network = None
+        self.routes = None
+        self._snapshot = None
+        if backend == 'local':
+            self.network = TrainNetwork.from_csv()
+            self.routes = RouteTable.open()
+        else:
+            self.driver = instrument.InstrumentedDriver(GraphDatabase.driver(uri))
 
     def close(self):
-        self.driver.close()
+        if self.driver is not None:
+            self.driver.close()
 
-    def display_cities(self):
-        map_1 = folium.Map(location=center_switzerland, zoom_start=8)
+    # fetch the data of all the maps once, in a single session
+    @instrument.timed()
+    def snapshot(self):
+        if self._snapshot is None:
+            if self.network is not None:
+                self._snapshot = self._snapshot_local(self.network, self.routes)
+            else:
+                with self.driver.session() as session:
+                    self._snapshot = session.execute_read(self._fetch_snapshot)
+        return self._snapshot
+
+    # cities from which the given city is reachable in 1 to max_hops lines,
+    # with a population greater than min_population, each returned once
+    def cities_within_hops(self, name, max_hops, min_population=0):
+        if self.network is not None:
+            return self.network.cities_within_hops(name, max_hops, min_population)
         with self.driver.session() as session:
-            session.read_transaction(self._display_cities, map_1)
-        map_1.save('out/1.html')
+            return session.execute_read(self._cities_within_hops, name, max_hops, min_population)
+
+    # render the given maps from the snapshot, in worker processes if workers > 1
+    # compact and cluster select the GeoJSON output, see display_cities_layer
+    @instrument.timed()
+    def render(self, filenames=tuple(MAPS), workers=1, compact=False, cluster=False):
+        snapshot = self.snapshot()
+        n = len(filenames)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(render_map, [snapshot] * n, filenames, ['out'] * n,
+                                         [compact] * n, [cluster] * n))
+        return [render_map(snapshot, filename, compact=compact, cluster=cluster) for filename in filenames]
+
+    def display_cities(self):
+        self.render(['1.html'])
 
     def display_lines(self):
-        map_2 = folium.Map(location=center_switzerland, zoom_start=8)
-        with self.driver.session() as session:
-            session.read_transaction(self._display_cities, map_2)
-            session.read_transaction(self._display_lines, map_2)
-        map_2.save('out/2.1.html')
+        self.render(['2.1.html'])
 
     def display_city_requests(self):
-        map_2_2 = folium.Map(location=center_switzerland, zoom_start=8)
-        with self.driver.session() as session:
-            session.read_transaction(self._display_cities_request, map_2_2)
-        map_2_2.save('out/2.2.html')
+        self.render(['2.2.html'])
 
     def display_shortest_path_km(self):
-        map_2_3_1 = folium.Map(location=center_switzerland, zoom_start=8)
-        with self.driver.session() as session:
-            session.read_transaction(self._display_shortest_path_km, map_2_3_1)
-        map_2_3_1.save('out/2.3.1.html')
+        self.render(['2.3.1.html'])
 
     def display_shortest_path_time(self):
-        map_2_3_2 = folium.Map(location=center_switzerland, zoom_start=8)
-        with self.driver.session() as session:
-            session.read_transaction(self._display_shortest_path_time, map_2_3_2)
-        map_2_3_2.save('out/2.3.2.html')
+        self.render(['2.3.2.html'])
 
     def display_minst(self):
-        map_2_4 = folium.Map(location=center_switzerland, zoom_start=8)
-        with self.driver.session() as session:
-            session.read_transaction(self._display_cities, map_2_4)
-            session.read_transaction(self._display_lines, map_2_4)
-            session.read_transaction(self._display_minst, map_2_4)
-        map_2_4.save('out/2.4.html')
-            
-
+        self.render(['2.4.html'])
 
     @staticmethod
-    def _display_cities(tx, m):
-        query = (
-            """
-            MATCH (c:City)
-            RETURN c
-            """
-        )
-        result = tx.run(query)
-        for record in result:
-            display_city_on_map(
-                m=m,
-                popup=record['c']['name'],
-                latitude=record['c']['latitude'],
-                longitude=record['c']['longitude']
-            )
+    def _fetch_snapshot(tx):
+        snapshot = {}
+        snapshot['cities'], snapshot['lines'] = network_from_records(tx.run(NETWORK_QUERY))
+        snapshot['city_requests'] = DisplayTrainNetwork._cities_within_hops(tx, 'Luzern', 4, 100000)
+        for key, (source, target, graph, weight) in SHORTEST_PATHS.items():
+            record = tx.run(SHORTEST_PATH_QUERY, source=source, target=target, graph=graph, weight=weight).single()
+            snapshot[key] = record['nodeNames'] if record else []
+        snapshot['minst'] = [(record['c1'], record['c2']) for record in tx.run(MINST_QUERY)]
+        return snapshot
 
     @staticmethod
-    def _display_lines(tx, m):
-        query = (
-            """
-            MATCH (c1:City)-[l:Line]->(c2:City)
-            RETURN c1, c2
-            """
-        )
-        result = tx.run(query)
-        for record in result:
-            # print(record)
-            display_polyline_on_map(
-                m=m,
-                locations=[(record['c1']['latitude'], record['c1']['longitude']),(record['c2']['latitude'], record['c2']['longitude'])]
-            )
-            
-    @staticmethod
-    def _display_cities_request(tx, m):
-        query = (
-            """
-            MATCH(c1:City)-[:Line*1..4]->(c2:City {name: 'Luzern'})
-            where(c1.population > 100000)
-            return c1
-            """
-        )
-        result = tx.run(query)
-        for record in result:
-            display_city_on_map(
-                m=m,
-                popup=record['c1']['name'],
-                latitude=record['c1']['latitude'],
-                longitude=record['c1']['longitude']
-            )
-
-
-    @staticmethod
-    def _display_shortest_path_km(tx, m):
-        query = (
-            """
-            MATCH (source:City {name: 'Geneve'}), (target:City {name: 'Chur'})
-            CALL gds.shortestPath.dijkstra.stream('lineKM', {
-                sourceNode: source,
-                targetNode: target,
-                relationshipWeightProperty: 'km'
-            })
-            YIELD index, sourceNode, targetNode, totalCost, nodeIds, costs, path
-            RETURN
-                index,
-                gds.util.asNode(sourceNode).name AS sourceNodeName,
-                gds.util.asNode(targetNode).name AS targetNodeName,
-                totalCost,
-                [nodeId IN nodeIds | gds.util.asNode(nodeId).name] AS nodeNames,
-                costs,
-                nodes(path) as path
-            ORDER BY index
-            """
-        )
-        result = tx.run(query)
-        path_cities=[]
-        for record in result:
-            for node in record['path']:
-                path_cities.append(node)
-        for city in path_cities:
-            display_city_on_map(
-                m=m,
-                popup=city['name'],
-                latitude=city['latitude'],
-                longitude=city['longitude']
-            )
-        for i in range(1, len(path_cities)):
-            display_polyline_on_map(
-                m=m,
-                locations=[(path_cities[i-1]['latitude'], path_cities[i-1]['longitude']), (path_cities[i]['latitude'], path_cities[i]['longitude'])]
-            )
+    def _cities_within_hops(tx, name, max_hops, min_population):
+        result = tx.run(CITIES_WITHIN_HOPS_QUERY, name=name, max_hops=max_hops, min_population=min_population)
+        return [record['name'] for record in result]
 
     @staticmethod
-    def _display_shortest_path_time(tx, m):
-        query = (
-            """
-            MATCH (source:City {name: 'Geneve'}), (target:City {name: 'Chur'})
-            CALL gds.shortestPath.dijkstra.stream('lineTime', {
-                sourceNode: source,
-                targetNode: target,
-                relationshipWeightProperty: 'time'
-            })
-            YIELD index, sourceNode, targetNode, totalCost, nodeIds, costs, path
-            RETURN
-                index,
-                gds.util.asNode(sourceNode).name AS sourceNodeName,
-                gds.util.asNode(targetNode).name AS targetNodeName,
-                totalCost,
-                [nodeId IN nodeIds | gds.util.asNode(nodeId).name] AS nodeNames,
-                costs,
-                nodes(path) as path
-            ORDER BY index
-            """
-        )
-        result = tx.run(query)
-        path_cities=[]
-        for record in result:
-            for node in record['path']:
-                path_cities.append(node)
-        for city in path_cities:
-            display_city_on_map(
-                m=m,
-                popup=city['name'],
-                latitude=city['latitude'],
-                longitude=city['longitude']
-            )
-        for i in range(1, len(path_cities)):
-            display_polyline_on_map(
-                m=m,
-                locations=[(path_cities[i-1]['latitude'], path_cities[i-1]['longitude']), (path_cities[i]['latitude'], path_cities[i]['longitude'])]
-            )
-
-    @staticmethod
-    def _display_minst(tx, m):
-        query = (
-            """
-            MATCH path = (c:City {name: 'Bern'})-[:MINST*]-()
-            WITH relationships(path) AS rels
-            UNWIND rels AS rel
-            WITH DISTINCT rel AS rel
-            RETURN startNode(rel) AS c1, endNode(rel) AS c2
-            """
-        )
-        result = tx.run(query)
-        for record in result:
-            # print(record)
-            display_polyline_on_map(
-                m=m,
-                locations=[(record['c1']['latitude'], record['c1']['longitude']),(record['c2']['latitude'], record['c2']['longitude'])],
-                color='#d11b1b'
-            )
+    def _snapshot_local(network, routes):
+        city1, city2 = network.edges
+        return {
+            'cities': {name: (network.latitude[i], network.longitude[i]) for i, name in enumerate(network.names)},
+            'lines': [(i, network.names[a], network.names[b]) for i, (a, b) in enumerate(zip(city1, city2))],
+            'city_requests': network.cities_within_hops('Luzern', 4, 100000),
+            'path_km': routes.route('Geneve', 'Chur', 'km')[1],
+            'path_time': routes.route('Geneve', 'Chur', 'time')[1],
+            'minst': [(c1, c2) for c1, c2, _ in network.prim('Bern')],
+        }
 
 
 if __name__ == "__main__":
-    display_train_network = DisplayTrainNetwork("neo4j://localhost:7687")
+    parser = argparse.ArgumentParser(description="Display the train network on maps.")
+    parser.add_argument("--backend", choices=["neo4j", "local"], default="neo4j",
+                        help="query Neo4j or compute the maps in-process from the CSV files")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes rendering the maps")
+    parser.add_argument("--compact", action="store_true",
+                        help="draw cities and lines as single GeoJSON layers")
+    parser.add_argument("--cluster", action="store_true",
+                        help="cluster the cities in compact mode")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write timings, counters and server times to FILE (Prometheus text if it ends with .prom)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve timings, counters and server times on http://127.0.0.1:PORT/metrics, "
+                             "until interrupted once the work is done")
+    args = parser.parse_args()
+
+    instrument.configure(args.metrics, args.metrics_port)
 
-    center_switzerland = [46.800663464, 8.222665776]
+    display_train_network = DisplayTrainNetwork("neo4j://localhost:7687", backend=args.backend)
 
-    # display cities on the map
-    display_train_network.display_cities()
-    display_train_network.display_lines()
-    display_train_network.display_city_requests()
-    display_train_network.display_shortest_path_km()
-    display_train_network.display_shortest_path_time()
-    display_train_network.display_minst()
\ No newline at end of file
+    # fetch the network once and render all the maps from it
+    display_train_network.render(workers=args.workers, compact=args.compact, cluster=args.cluster)
+    display_train_network.close()
+    instrument.finish(args.metrics)
\ No newline at end of file
@@ -0,0 +1,201 @@
+import heapq
+import math
+
+import numpy as np
+import pandas as pd
+
+
+EARTH_RADIUS_KM = 6371.0
+
+
+# great-circle distance in km between points given in degrees (works on arrays)
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class TrainNetwork:
+    """
+    In-memory train network, an alternative to the Neo4j graph and its GDS projections.
+
+    Cities are numbered in the order of cities.csv. Each line of lines.csv is
+    stored as two directed arcs, like the two Line relationships of the graph,
+    in a CSR adjacency: the arcs leaving city u are indptr[u]:indptr[u + 1] of
+    the targets and weights arrays.
+    """
+
+    def __init__(self, cities, lines):
+        self.cities = cities.reset_index(drop=True)
+        self.lines = lines.reset_index(drop=True)
+        self.names = self.cities['name'].tolist()
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.latitude = self.cities['latitude'].to_numpy(dtype=np.float64)
+        self.longitude = self.cities['longitude'].to_numpy(dtype=np.float64)
+        self.population = self.cities['population'].to_numpy(dtype=np.int64)
+
+        city1 = self.lines['city1'].map(self.index).to_numpy(dtype=np.int64)
+        city2 = self.lines['city2'].map(self.index).to_numpy(dtype=np.int64)
+        # the cost of a line is the one used for the minimum spanning tree
+        line_weights = {
+            'km': self.lines['km'].to_numpy(dtype=np.float64),
+            'time': self.lines['time'].to_numpy(dtype=np.float64),
+            'cost': (self.lines['nbTracks'] * self.lines['km']).to_numpy(dtype=np.float64),
+        }
+
+        sources = np.concatenate((city1, city2))
+        targets = np.concatenate((city2, city1))
+        order = np.argsort(sources, kind='stable')
+        self.indptr = np.zeros(len(self.names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self.names)), out=self.indptr[1:])
+        self.targets = targets[order].astype(np.int32)
+        self.weights = {name: np.concatenate((w, w))[order] for name, w in line_weights.items()}
+        self.edges = (city1, city2)
+        self.line_weights = line_weights
+        self._heuristic_scale = {}
+
+    @classmethod
+    def from_csv(cls, cities_path='data/cities.csv', lines_path='data/lines.csv'):
+        return cls(pd.read_csv(cities_path, sep=';'), pd.read_csv(lines_path, sep=';'))
+
+    def city(self, i):
+        return {
+            'name': self.names[i],
+            'latitude': self.latitude[i],
+            'longitude': self.longitude[i],
+            'population': int(self.population[i]),
+        }
+
+    def neighbors(self, u, weight):
+        start, end = self.indptr[u], self.indptr[u + 1]
+        return zip(self.targets[start:end].tolist(), self.weights[weight][start:end].tolist())
+
+    # rebuild the path from the predecessors of each visited node
+    def _path(self, predecessors, source, target):
+        path = [target]
+        while path[-1] != source:
+            path.append(predecessors[path[-1]])
+        return [self.names[i] for i in reversed(path)]
+
+    # best-first search from source to target, ordered by cost + heuristic(node)
+    def _search(self, source, target, weight, heuristic):
+        s, t = self.index[source], self.index[target]
+        distances = {s: 0.0}
+        predecessors = {}
+        settled = set()
+        heap = [(heuristic(s), 0.0, s)]
+        while heap:
+            _, d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if u == t:
+                return d, self._path(predecessors, s, t)
+            settled.add(u)
+            for v, w in self.neighbors(u, weight):
+                if v not in settled and d + w < distances.get(v, math.inf):
+                    distances[v] = d + w
+                    predecessors[v] = u
+                    heapq.heappush(heap, (d + w + heuristic(v), d + w, v))
+        return math.inf, []
+
+    # cities from which the given city can be reached in 1 to max_hops lines, with
+    # a population greater than min_population; each city is returned once, the
+    # given city excluded. A breadth-first search visits each city and line at most
+    # once, where enumerating the paths grows exponentially with max_hops.
+    def cities_within_hops(self, name, max_hops, min_population=0):
+        source = self.index[name]
+        visited = np.zeros(len(self.names), dtype=bool)
+        visited[source] = True
+        frontier = np.array([source])
+        for _ in range(max_hops):
+            if len(frontier) == 0:
+                break
+            # targets of all the arcs leaving the frontier
+            starts, ends = self.indptr[frontier], self.indptr[frontier + 1]
+            arcs = np.concatenate([np.arange(a, b) for a, b in zip(starts, ends)])
+            reached = np.unique(self.targets[arcs]) if len(arcs) else np.array([], dtype=np.int64)
+            frontier = reached[~visited[reached]]
+            visited[frontier] = True
+        visited[source] = False
+        found = np.flatnonzero(visited & (self.population > min_population))
+        return [self.names[i] for i in found]
+
+    # shortest paths from a city to all the others with Dijkstra, returns the
+    # distances and the predecessor of each city on its path (-1 if unreachable)
+    def shortest_path_tree(self, source, weight='km'):
+        distances = np.full(len(self.names), np.inf)
+        predecessors = np.full(len(self.names), -1, dtype=np.int32)
+        distances[source] = 0.0
+        settled = np.zeros(len(self.names), dtype=bool)
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if settled[u]:
+                continue
+            settled[u] = True
+            for v, w in self.neighbors(u, weight):
+                if d + w < distances[v]:
+                    distances[v] = d + w
+                    predecessors[v] = u
+                    heapq.heappush(heap, (d + w, v))
+        return distances, predecessors
+
+    # shortest path between two cities with Dijkstra, returns (total cost, city names)
+    def dijkstra(self, source, target, weight='km'):
+        return self._search(source, target, weight, lambda v: 0.0)
+
+    # shortest path between two cities with A*, guided by the distance as the crow flies
+    def astar(self, source, target, weight='km'):
+        t = self.index[target]
+        scale = self._heuristic_scale_for(weight)
+        straight = haversine(self.latitude, self.longitude, self.latitude[t], self.longitude[t]) * scale
+        return self._search(source, target, weight, lambda v: straight[v])
+
+    # the heuristic is the distance as the crow flies scaled by the smallest weight
+    # per km of any line: it never overestimates, so A* stays exact for any weight
+    def _heuristic_scale_for(self, weight):
+        if weight not in self._heuristic_scale:
+            city1, city2 = self.edges
+            straight = haversine(self.latitude[city1], self.longitude[city1],
+                                 self.latitude[city2], self.longitude[city2])
+            ratios = self.line_weights[weight][straight > 0] / straight[straight > 0]
+            self._heuristic_scale[weight] = float(ratios.min()) if len(ratios) else 0.0
+        return self._heuristic_scale[weight]
+
+    # minimum spanning tree of the component of start with Prim, returns (city1, city2, weight) edges
+    def prim(self, start='Bern', weight='cost'):
+        s = self.index[start]
+        visited = {s}
+        tree = []
+        heap = [(w, s, v) for v, w in self.neighbors(s, weight)]
+        heapq.heapify(heap)
+        while heap:
+            w, u, v = heapq.heappop(heap)
+            if v in visited:
+                continue
+            visited.add(v)
+            tree.append((self.names[u], self.names[v], w))
+            for x, wx in self.neighbors(v, weight):
+                if x not in visited:
+                    heapq.heappush(heap, (wx, v, x))
+        return tree
+
+    # minimum spanning forest with Kruskal, returns (city1, city2, weight) edges
+    def kruskal(self, weight='cost'):
+        parent = list(range(len(self.names)))
+
+        def find(u):
+            while parent[u] != u:
+                parent[u] = parent[parent[u]]
+                u = parent[u]
+            return u
+
+        city1, city2 = self.edges
+        weights = self.line_weights[weight]
+        tree = []
+        for e in np.argsort(weights, kind='stable'):
+            root1, root2 = find(city1[e]), find(city2[e])
+            if root1 != root2:
+                parent[root1] = root2
+                tree.append((self.names[city1[e]], self.names[city2[e]], float(weights[e])))
+        return tree
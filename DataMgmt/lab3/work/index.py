@@ -1,173 +1,432 @@
+import argparse
 from os import name
 from neo4j import GraphDatabase
 import pandas as pd
 
+from graph import TrainNetwork
+import instrument
+
+
+CITY_PROPERTIES = ('latitude', 'longitude', 'population')
+LINE_PROPERTIES = ('km', 'time', 'nbTracks')
+
+# GDS projections and the line property they are weighted by
+PROJECTIONS = {'lineKM': 'km', 'lineTime': 'time'}
+
+# queries shared by GenerateTrainNetwork and the async mode of aio.AsyncGenerateTrainNetwork
+
+# the uniqueness constraint also creates the index used to look up cities by name
+CITY_CONSTRAINT_QUERY = (
+    """
+    CREATE CONSTRAINT city_name IF NOT EXISTS
+    ON (c:City) ASSERT c.name IS UNIQUE
+    """
+)
+
+# cities and lines are MERGEd so that a name repeated in the files or a load run
+# again updates them instead of failing on the constraint or duplicating the lines
+MERGE_CITIES_QUERY = (
+    """
+    UNWIND $rows AS row
+    MERGE (c:City {name: row.name})
+    SET c += {latitude: row.latitude, longitude: row.longitude, population: row.population}
+    """
+)
+
+MERGE_LINES_QUERY = (
+    """
+    UNWIND $rows AS row
+    MATCH (c1:City {name: row.city1})
+    MATCH (c2:City {name: row.city2})
+    MERGE (c1)-[l1:Line]->(c2)
+    MERGE (c2)-[l2:Line]->(c1)
+    SET l1 += {km: row.km, time: row.time, nbTracks: row.nbTracks},
+        l2 += {km: row.km, time: row.time, nbTracks: row.nbTracks}
+    """
+)
+
+# the relationships are not returned, only their cost is set
+ADD_COST_QUERY = (
+    """
+    MATCH (c1:City)-[l:Line]->(c2:City)
+    SET l.cost = l.nbTracks * l.km
+    """
+)
+
+# gds.graph.create fails if the projection already exists
+DROP_GRAPH_QUERY = (
+    """
+    CALL gds.graph.exists($graph) YIELD exists
+    WITH exists WHERE exists
+    CALL gds.graph.drop($graph) YIELD graphName
+    RETURN graphName
+    """
+)
+
+CREATE_GRAPH_QUERY = (
+    """
+    CALL gds.graph.create($graph, 'City', 'Line', {relationshipProperties: $weight})
+    """
+)
+
+# the spanning tree procedure writes new MINST relationships, the ones of a previous build are deleted first
+DELETE_MINST_QUERY = (
+    """
+    MATCH (:City)-[m:MINST]->(:City)
+    DELETE m
+    """
+)
+
+CREATE_MINST_QUERY = (
+    """
+    MATCH (c:City {name: 'Bern'})
+    CALL gds.alpha.spanningTree.minimum.write({
+    nodeProjection: 'City',
+    relationshipProjection: {
+        Line: {
+        type: 'Line',
+        properties: 'cost',
+        orientation: 'UNDIRECTED'
+        }
+    },
+    startNodeId: id(c),
+    relationshipWeightProperty: 'cost',
+    writeProperty: 'MINST',
+    weightWriteProperty: 'writeCost'
+    })
+    YIELD createMillis, computeMillis, writeMillis, effectiveNodeCount
+    RETURN createMillis, computeMillis, writeMillis, effectiveNodeCount;
+    """
+)
+
+
+# split a list of rows into batches of at most batch_size rows
+def batches(rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+# a line is stored as two relationships, its key is the same for both directions
+def line_key(row):
+    return tuple(sorted((row['city1'], row['city2'])))
+
+
+# compare the rows of a CSV file with the rows stored in the graph ({key: row}),
+# returns the rows to insert or update and the keys of the rows to delete
+def diff_rows(rows, stored, key, properties):
+    wanted = {key(row): row for row in rows}
+    upserts = [row for k, row in wanted.items()
+               if k not in stored or any(stored[k][p] != row[p] for p in properties)]
+    deletes = [k for k in stored if k not in wanted]
+    return upserts, deletes
+
+
+# minimum spanning tree of the component of start after the lines changed, as {line key: (city1, city2, cost)}
+# A new or cheaper line can only replace the most expensive line of the cycle it closes
+# in the tree, so the tree of the old tree lines and the changed lines is the new tree.
+# When a tree line is removed or gets more expensive, any line crossing the cut may
+# replace it, and when a line joins another component to the one of start, the lines
+# of that component were never in the tree: the tree is then computed from all the lines.
+def update_minimum_spanning_tree(cities, lines, tree, line_upserts, line_deletes, stored_lines, start='Bern'):
+    cost = lambda row: row['nbTracks'] * row['km']
+    component = {start} | {city for c1, c2, _ in tree.values() for city in (c1, c2)}
+    full = any(k in tree for k in line_deletes) or any(
+        row['city1'] not in component or row['city2'] not in component
+        or line_key(row) in tree and cost(row) > cost(stored_lines[line_key(row)])
+        for row in line_upserts
+    )
+    if not full:
+        candidates = set(tree) | {line_key(row) for row in line_upserts}
+        lines = lines[lines.apply(line_key, axis=1).isin(candidates)]
+    return {
+        tuple(sorted((c1, c2))): (c1, c2, w)
+        for c1, c2, w in TrainNetwork(cities, lines).prim(start, 'cost')
+    }
+
 
 class GenerateTrainNetwork:
 
-    def __init__(self, uri):
-        self.driver = GraphDatabase.driver(uri)
+    def __init__(self, uri, batch_size=1000):
+        self.driver = instrument.InstrumentedDriver(GraphDatabase.driver(uri))
+        self.batch_size = batch_size
 
     def close(self):
         self.driver.close()
 
+    def create_constraints(self):
+        with self.driver.session() as session:
+            session.execute_write(
+                self._create_city_constraint
+            )
+
     def create_cities(self):
         cities = pd.read_csv('data/cities.csv', sep=';')
-        for index, row in cities.iterrows():
-            with self.driver.session() as session:
-                session.write_transaction(
-                    self._create_city,
-                    row['name'],
-                    row['latitude'],
-                    row['longitude'],
-                    row['population']
+        rows = cities.to_dict('records')
+        with self.driver.session() as session:
+            for batch in batches(rows, self.batch_size):
+                session.execute_write(
+                    self._create_cities,
+                    batch
                 )
 
     def create_lines(self):
         lines = pd.read_csv('data/lines.csv', sep=';')
-        for index, row in lines.iterrows():
-            with self.driver.session() as session:
-                session.write_transaction(
-                    self._create_line,
-                    row['city1'],
-                    row['city2'],
-                    row['km'],
-                    row['time'],
-                    row['nbTracks']
+        rows = lines.to_dict('records')
+        with self.driver.session() as session:
+            for batch in batches(rows, self.batch_size):
+                session.execute_write(
+                    self._create_lines,
+                    batch
                 )
 
     def add_cost_property(self):
         with self.driver.session() as session:
-            session.write_transaction(
+            session.execute_write(
                 self._add_cost_property
             )
 
     def create_graph_lines_km(self):
         with self.driver.session() as session:
-            session.write_transaction(
+            session.execute_write(
+                self._drop_graph,
+                'lineKM'
+            )
+            session.execute_write(
                 self._create_graph_lines_km
             )
     
     def create_graph_lines_time(self):
         with self.driver.session() as session:
-            session.write_transaction(
+            session.execute_write(
+                self._drop_graph,
+                'lineTime'
+            )
+            session.execute_write(
                 self._create_graph_lines_time
             )
 
     def create_minst(self):
          with self.driver.session() as session:
-            session.write_transaction(
+            session.execute_write(
+                self._delete_minst
+            )
+            session.execute_write(
                 self._create_minst
             )
 
+    # bring the stored graph up to date with the CSV files by applying only the
+    # differences, instead of creating everything again; returns the number of
+    # changes of each kind
+    @instrument.timed()
+    def sync(self, cities_path='data/cities.csv', lines_path='data/lines.csv', start='Bern'):
+        cities = pd.read_csv(cities_path, sep=';')
+        lines = pd.read_csv(lines_path, sep=';')
+        with self.driver.session() as session:
+            stored_cities, stored_lines, stored_minst = session.execute_read(self._fetch_network)
+
+        city_upserts, city_deletes = diff_rows(
+            cities.to_dict('records'), stored_cities, lambda row: row['name'], CITY_PROPERTIES)
+        line_upserts, line_deletes = diff_rows(
+            lines.to_dict('records'), stored_lines, line_key, LINE_PROPERTIES)
+
+        # a projection only changes with its weight or the topology of the network
+        changed = set(LINE_PROPERTIES) if line_deletes or city_deletes or any(
+            row['name'] not in stored_cities for row in city_upserts) else set()
+        for row in line_upserts:
+            old = stored_lines.get(line_key(row))
+            changed |= set(LINE_PROPERTIES) if old is None else {p for p in LINE_PROPERTIES if old[p] != row[p]}
+        projections = [graph for graph, weight in PROJECTIONS.items() if weight in changed]
+
+        tree = stored_minst
+        if line_upserts or line_deletes or city_deletes:
+            tree = update_minimum_spanning_tree(cities, lines, stored_minst, line_upserts,
+                                                line_deletes, stored_lines, start)
+        minst_upserts = [{'city1': c1, 'city2': c2, 'cost': w} for k, (c1, c2, w) in tree.items()
+                         if k not in stored_minst or stored_minst[k][2] != w]
+        minst_deletes = [list(k) for k in stored_minst if k not in tree]
+
+        with self.driver.session() as session:
+            for batch in batches(city_upserts, self.batch_size):
+                session.execute_write(self._merge_cities, batch)
+            for batch in batches([list(k) for k in line_deletes], self.batch_size):
+                session.execute_write(self._delete_relationships, 'Line', batch)
+            for batch in batches(line_upserts, self.batch_size):
+                session.execute_write(self._merge_lines, batch)
+            for batch in batches(city_deletes, self.batch_size):
+                session.execute_write(self._delete_cities, batch)
+            for graph in projections:
+                session.execute_write(self._drop_graph, graph)
+                session.execute_write(self._create_graph, graph, PROJECTIONS[graph])
+            for batch in batches(minst_deletes, self.batch_size):
+                session.execute_write(self._delete_relationships, 'MINST', batch)
+            for batch in batches(minst_upserts, self.batch_size):
+                session.execute_write(self._merge_minst, batch)
+
+        return {
+            'cities_upserted': len(city_upserts),
+            'cities_deleted': len(city_deletes),
+            'lines_upserted': len(line_upserts),
+            'lines_deleted': len(line_deletes),
+            'projections_refreshed': projections,
+            'minst_upserted': len(minst_upserts),
+            'minst_deleted': len(minst_deletes),
+        }
+
 
     @staticmethod
-    def _create_city(tx, name, latitude, longitude, population):
+    def _create_city_constraint(tx):
+        result = tx.run(CITY_CONSTRAINT_QUERY)
+
+    @staticmethod
+    def _create_cities(tx, rows):
+        result = tx.run(MERGE_CITIES_QUERY, rows=rows)
+
+    @staticmethod
+    def _create_lines(tx, rows):
+        result = tx.run(MERGE_LINES_QUERY, rows=rows)
+
+    @staticmethod
+    def _add_cost_property(tx):
+        result = tx.run(ADD_COST_QUERY)
+    
+    @staticmethod
+    def _create_graph_lines_km(tx):
+        GenerateTrainNetwork._create_graph(tx, 'lineKM', PROJECTIONS['lineKM'])
+
+    @staticmethod
+    def _create_graph_lines_time(tx):
+        GenerateTrainNetwork._create_graph(tx, 'lineTime', PROJECTIONS['lineTime'])
+
+    @staticmethod
+    def _drop_graph(tx, graph):
+        result = tx.run(DROP_GRAPH_QUERY, graph=graph)
+
+    @staticmethod
+    def _create_graph(tx, graph, weight):
+        result = tx.run(CREATE_GRAPH_QUERY, graph=graph, weight=weight)
+        instrument.observe_gds(graph, result.single())
+
+    @staticmethod
+    def _fetch_network(tx):
         query = (
             """
-            CREATE (c:City { name: $name, latitude: $latitude, longitude: $longitude, population: $population })
-            RETURN c
+            MATCH (c:City)
+            RETURN c.name AS name, c.latitude AS latitude, c.longitude AS longitude, c.population AS population
             """
         )
-        result = tx.run(query, name=name, latitude=latitude, longitude=longitude, population=population)
-
-        city_created = result.single()['c']
-        print("Created City: {name}".format(name=city_created['name']))
+        cities = {record['name']: dict(record) for record in tx.run(query)}
 
-    @staticmethod
-    def _create_line(tx, city1, city2, km, time, nbTracks):
         query = (
             """
-            MATCH (c1:City), (c2:City)
-            WHERE c1.name = $city1 AND c2.name = $city2
-            CREATE (c1)-[l1:Line {km: $km, time: $time, nbTracks: $nbTracks}]->(c2)
-            CREATE (c2)-[l2:Line {km: $km, time: $time, nbTracks: $nbTracks}]->(c1)
-            RETURN l1, l2
+            MATCH (c1:City)-[l:Line]->(c2:City)
+            WHERE c1.name < c2.name
+            RETURN c1.name AS city1, c2.name AS city2, l.km AS km, l.time AS time, l.nbTracks AS nbTracks
             """
         )
-        result = tx.run(query, city1=city1, city2=city2, km=km, time=time, nbTracks=nbTracks)
+        lines = {line_key(record): dict(record) for record in tx.run(query)}
 
-        line_created = result.single()['l1']
-        # print("Created Line: {city1} - {city2}".format(city1=line_created['c1'], city2=line_created['c2']))
+        query = (
+            """
+            MATCH (c1:City)-[m:MINST]->(c2:City)
+            RETURN c1.name AS city1, c2.name AS city2, m.writeCost AS cost
+            """
+        )
+        minst = {line_key(record): (record['city1'], record['city2'], record['cost']) for record in tx.run(query)}
+        return cities, lines, minst
 
     @staticmethod
-    def _add_cost_property(tx):
+    def _merge_cities(tx, rows):
+        result = tx.run(MERGE_CITIES_QUERY, rows=rows)
 
+    @staticmethod
+    def _delete_cities(tx, names):
         query = (
             """
-            Match (c1:City)-[l:Line]-(c2:City)
-            Set l.cost = l.nbTracks * l.km
-            return l
+            UNWIND $names AS name
+            MATCH (c:City {name: name})
+            DETACH DELETE c
             """
         )
-        result = tx.run(query)
-    
+        result = tx.run(query, names=names)
+
     @staticmethod
-    def _create_graph_lines_km(tx):
+    def _merge_lines(tx, rows):
+        # the cost is only computed for the lines that changed
         query = (
             """
-            CALL gds.graph.create(
-                'lineKM',
-                'City',
-                'Line',
-                {
-                    relationshipProperties: 'km'
-                }
-            )
+            UNWIND $rows AS row
+            MATCH (c1:City {name: row.city1})
+            MATCH (c2:City {name: row.city2})
+            MERGE (c1)-[l1:Line]->(c2)
+            MERGE (c2)-[l2:Line]->(c1)
+            FOREACH (l IN [l1, l2] |
+                SET l.km = row.km, l.time = row.time, l.nbTracks = row.nbTracks, l.cost = row.nbTracks * row.km)
             """
         )
-        result = tx.run(query)
+        result = tx.run(query, rows=rows)
 
     @staticmethod
-    def _create_graph_lines_time(tx):
+    def _delete_relationships(tx, type, pairs):
+        # the type is not a parameter in Cypher, it is one of 'Line' or 'MINST'
         query = (
             """
-            CALL gds.graph.create(
-                'lineTime',
-                'City',
-                'Line',
-                {
-                    relationshipProperties: 'time'
-                }
-            )
-            """
+            UNWIND $pairs AS pair
+            MATCH (:City {name: pair[0]})-[r:%s]-(:City {name: pair[1]})
+            DELETE r
+            """ % type
         )
-        result = tx.run(query)
+        result = tx.run(query, pairs=pairs)
 
     @staticmethod
-    def _create_minst(tx):
+    def _merge_minst(tx, rows):
         query = (
             """
-            MATCH (c:City {name: 'Bern'})
-            CALL gds.alpha.spanningTree.minimum.write({
-            nodeProjection: 'City',
-            relationshipProjection: {
-                Line: {
-                type: 'Line',
-                properties: 'cost',
-                orientation: 'UNDIRECTED'
-                }
-            },
-            startNodeId: id(c),
-            relationshipWeightProperty: 'cost',
-            writeProperty: 'MINST',
-            weightWriteProperty: 'writeCost'
-            })
-            YIELD createMillis, computeMillis, writeMillis, effectiveNodeCount
-            RETURN createMillis, computeMillis, writeMillis, effectiveNodeCount;
+            UNWIND $rows AS row
+            MATCH (c1:City {name: row.city1})
+            MATCH (c2:City {name: row.city2})
+            OPTIONAL MATCH (c1)-[old:MINST]-(c2)
+            DELETE old
+            CREATE (c1)-[:MINST {writeCost: row.cost}]->(c2)
             """
         )
-        result = tx.run(query)
+        result = tx.run(query, rows=rows)
+
+    @staticmethod
+    def _delete_minst(tx):
+        result = tx.run(DELETE_MINST_QUERY)
+
+    @staticmethod
+    def _create_minst(tx):
+        result = tx.run(CREATE_MINST_QUERY)
+        instrument.observe_gds('minst', result.single())
     
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the train network in Neo4j.")
+    parser.add_argument("--sync", action="store_true",
+                        help="apply only the differences between the CSV files and the stored graph")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write timings, counters and server times to FILE (Prometheus text if it ends with .prom)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve timings, counters and server times on http://127.0.0.1:PORT/metrics, "
+                             "until interrupted once the work is done")
+    args = parser.parse_args()
+
+    instrument.configure(args.metrics, args.metrics_port)
+
     generate_train_network = GenerateTrainNetwork("neo4j://localhost:7687")
 
-    # create all city nodes
-    generate_train_network.create_cities()
-    generate_train_network.create_lines()
-    generate_train_network.create_graph_lines_km()
-    generate_train_network.create_graph_lines_time()
-    generate_train_network.add_cost_property()
-    generate_train_network.create_minst()
+    if args.sync:
+        print(generate_train_network.sync())
+    else:
+        # create all city nodes
+        generate_train_network.create_constraints()
+        generate_train_network.create_cities()
+        generate_train_network.create_lines()
+        generate_train_network.create_graph_lines_km()
+        generate_train_network.create_graph_lines_time()
+        generate_train_network.add_cost_property()
+        generate_train_network.create_minst()
+    generate_train_network.close()
+    instrument.finish(args.metrics)
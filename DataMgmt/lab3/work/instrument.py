@@ -0,0 +1,131 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'common'))
+from instrumentation import Registry
+
+
+# opt-in instrumentation of the Neo4j transactions, recorded in the shared Registry
+# of common/instrumentation.py: nothing is recorded until enable() is called.
+# Three kinds of measures are kept, so that the client overhead of a transaction
+# can be told from the time spent in the server:
+# - timings: wall time of the transactions and timed functions, seen from the client
+# - server: time reported by Neo4j in the summary of each query, and the
+#   createMillis, computeMillis and writeMillis yielded by the GDS procedures
+# - counters: queries, transactions, retries and the updates of the summaries
+
+GDS_TIMES = ('createMillis', 'computeMillis', 'writeMillis')
+SUMMARY_COUNTERS = ('nodes_created', 'nodes_deleted', 'relationships_created', 'relationships_deleted',
+                    'properties_set')
+
+
+REGISTRY = Registry('lab3')
+
+timer = REGISTRY.timer
+timed = REGISTRY.timed
+count = REGISTRY.count
+enable = REGISTRY.enable
+configure = REGISTRY.configure
+write = REGISTRY.write
+finish = REGISTRY.finish
+
+
+# record the times yielded by a GDS procedure, record is a neo4j.Record
+def observe_gds(name, record):
+    if record is None:
+        return
+    for key in GDS_TIMES:
+        if key in record.keys():
+            REGISTRY.observe_server('gds.%s.%s' % (name, key), record[key] / 1000)
+
+
+# server time and updates of a consumed query
+def _observe_summary(name, summary):
+    REGISTRY.observe_server('neo4j_query.' + name,
+                            ((summary.result_available_after or 0) + (summary.result_consumed_after or 0)) / 1000)
+    for counter in SUMMARY_COUNTERS:
+        value = getattr(summary.counters, counter)
+        if value:
+            REGISTRY.count('neo4j_%s' % counter, value)
+
+
+# transaction given to the transaction functions, which keeps the results of
+# its queries to read their summaries once the function returns
+class InstrumentedTransaction:
+
+    def __init__(self, tx):
+        self._tx = tx
+        self._results = []
+
+    def run(self, query, parameters=None, **kwparameters):
+        result = self._tx.run(query, parameters, **kwparameters)
+        self._results.append(result)
+        return result
+
+    # consuming discards the records the function did not read, like the commit does
+    def consume(self, name):
+        for result in self._results:
+            _observe_summary(name, result.consume())
+        REGISTRY.count('neo4j_queries', len(self._results))
+
+    def __getattr__(self, name):
+        return getattr(self._tx, name)
+
+
+class InstrumentedSession:
+
+    def __init__(self, session):
+        self._session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._session.close()
+
+    def execute_read(self, function, *args, **kwargs):
+        return self._transaction(self._session.execute_read, function, args, kwargs)
+
+    def execute_write(self, function, *args, **kwargs):
+        return self._transaction(self._session.execute_write, function, args, kwargs)
+
+    # the transaction function is timed by its name, without the leading underscore,
+    # a function run more than once was retried by the driver
+    def _transaction(self, execute, function, args, kwargs):
+        if not REGISTRY.enabled:
+            return execute(function, *args, **kwargs)
+        name = function.__name__.lstrip('_')
+        attempts = []
+
+        def work(tx, *args, **kwargs):
+            attempts.append(1)
+            instrumented = InstrumentedTransaction(tx)
+            value = function(instrumented, *args, **kwargs)
+            instrumented.consume(name)
+            return value
+
+        with REGISTRY.timer('neo4j_transaction.' + name):
+            value = execute(work, *args, **kwargs)
+        REGISTRY.count('neo4j_transactions')
+        if len(attempts) > 1:
+            REGISTRY.count('neo4j_retries', len(attempts) - 1)
+        return value
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+# driver whose sessions record their transactions when the instrumentation is enabled
+class InstrumentedDriver:
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def session(self, **config):
+        return InstrumentedSession(self._driver.session(**config))
+
+    def close(self):
+        self._driver.close()
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from graph import TrainNetwork
+
+
+WEIGHTS = ('km', 'time')
+
+
+# sha256 of the content of a file
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# weights of each line of the network, keyed by its (sorted) pair of cities
+def line_weights(network):
+    city1, city2 = network.edges
+    return {
+        tuple(sorted((network.names[a], network.names[b]))): {w: float(network.line_weights[w][i]) for w in WEIGHTS}
+        for i, (a, b) in enumerate(zip(city1, city2))
+    }
+
+
+# all-pairs shortest paths of a network for one weight, with one Dijkstra per city
+def build_tables(network, weight):
+    n = len(network.names)
+    dist = np.empty((n, n), dtype=np.float64)
+    pred = np.empty((n, n), dtype=np.int32)
+    for s in range(n):
+        dist[s], pred[s] = network.shortest_path_tree(s, weight)
+    return dist, pred
+
+
+# bring the tables of the old network up to date with the new network, which has the same cities
+def update_tables(dist, pred, network, old_lines, new_lines, weight):
+    index = network.index
+    increased = [pair for pair, w in old_lines.items()
+                 if pair not in new_lines or new_lines[pair][weight] > w[weight]]
+    decreased = [(pair, w[weight]) for pair, w in new_lines.items()
+                 if pair not in old_lines or w[weight] < old_lines[pair][weight]]
+
+    # a longer or removed line only changes the paths of the sources whose
+    # shortest path tree goes through it: these rows are computed again
+    affected = np.zeros(len(network.names), dtype=bool)
+    for c1, c2 in increased:
+        a, b = index[c1], index[c2]
+        affected |= (pred[:, b] == a) | (pred[:, a] == b)
+    for s in np.flatnonzero(affected):
+        dist[s], pred[s] = network.shortest_path_tree(s, weight)
+
+    # a shorter or new line u-v may shorten any path s -> t into s -> u -> v -> t
+    for (c1, c2), w in decreased:
+        for u, v in ((index[c1], index[c2]), (index[c2], index[c1])):
+            candidates = dist[:, u, None] + w + dist[None, v, :]
+            better = candidates < dist
+            via = pred[v].copy()
+            via[v] = u
+            dist[better] = candidates[better]
+            pred[:] = np.where(better, via[None, :], pred)
+
+    return int(affected.sum()), len(decreased)
+
+
+def _save(directory, name, array):
+    tmp = directory / (name + '.tmp.npy')
+    np.save(tmp, array)
+    os.replace(tmp, directory / (name + '.npy'))
+
+
+# build or update the route tables in directory if the CSV files changed,
+# returns 'unchanged', 'updated' or 'built'
+def refresh(directory='routes', cities_path='data/cities.csv', lines_path='data/lines.csv'):
+    directory = Path(directory)
+    manifest_path = directory / 'manifest.json'
+    hashes = {'cities': file_hash(cities_path), 'lines': file_hash(lines_path)}
+
+    manifest = None
+    if manifest_path.exists():
+        with manifest_path.open() as f:
+            manifest = json.load(f)
+        if manifest['hashes'] == hashes:
+            return 'unchanged'
+
+    network = TrainNetwork.from_csv(cities_path, lines_path)
+    new_lines = line_weights(network)
+    incremental = manifest is not None and manifest['names'] == network.names
+    directory.mkdir(parents=True, exist_ok=True)
+    # each table is replaced on its own, so the manifest is removed before the first one
+    # and written after the last one: a refresh interrupted in between leaves no manifest,
+    # and the next one builds all the tables again instead of trusting mixed ones
+    manifest_path.unlink(missing_ok=True)
+
+    for weight in WEIGHTS:
+        if incremental:
+            old_lines = {tuple(line['cities']): line['weights'] for line in manifest['lines']}
+            dist = np.load(directory / f'{weight}.dist.npy')
+            pred = np.load(directory / f'{weight}.pred.npy')
+            update_tables(dist, pred, network, old_lines, new_lines, weight)
+        else:
+            dist, pred = build_tables(network, weight)
+        _save(directory, f'{weight}.dist', dist)
+        _save(directory, f'{weight}.pred', pred)
+
+    manifest = {
+        'hashes': hashes,
+        'names': network.names,
+        'lines': [{'cities': list(pair), 'weights': w} for pair, w in new_lines.items()],
+    }
+    tmp = directory / 'manifest.json.tmp'
+    with tmp.open('w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_path)
+    return 'updated' if incremental else 'built'
+
+
+class RouteTable:
+    """
+    Precomputed shortest routes between all the cities, for the km and time weights.
+
+    For each weight, dist[s, t] is the length of the shortest route from city s
+    to city t and pred[s, t] the city before t on that route (-1 if there is
+    none), so a route is rebuilt in O(route length) by walking pred[s] back
+    from t. The tables are memory-mapped from the .npy files of the directory.
+    """
+
+    def __init__(self, directory='routes'):
+        directory = Path(directory)
+        with (directory / 'manifest.json').open() as f:
+            self.names = json.load(f)['names']
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.dist = {w: np.load(directory / f'{w}.dist.npy', mmap_mode='r') for w in WEIGHTS}
+        self.pred = {w: np.load(directory / f'{w}.pred.npy', mmap_mode='r') for w in WEIGHTS}
+
+    # open the tables, building or updating them first if the CSV files changed
+    @classmethod
+    def open(cls, directory='routes', cities_path='data/cities.csv', lines_path='data/lines.csv'):
+        refresh(directory, cities_path, lines_path)
+        return cls(directory)
+
+    def distance(self, source, target, weight='km'):
+        return float(self.dist[weight][self.index[source], self.index[target]])
+
+    # shortest route between two cities, returns (total cost, city names)
+    def route(self, source, target, weight='km'):
+        s, t = self.index[source], self.index[target]
+        total_cost = float(self.dist[weight][s, t])
+        if not np.isfinite(total_cost):
+            return total_cost, []
+        pred = self.pred[weight][s]
+        path = [t]
+        while path[-1] != s:
+            path.append(int(pred[path[-1]]))
+        return total_cost, [self.names[i] for i in reversed(path)]
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+# the async driver and the execute_read/execute_write sessions need the 5.x driver of requirement.txt
+pytest.importorskip('neo4j', minversion='5.0')
+
+import aio
+from index import ADD_COST_QUERY, CREATE_GRAPH_QUERY, CREATE_MINST_QUERY, MERGE_CITIES_QUERY, MERGE_LINES_QUERY
+
+
+# async driver recording the queries of the transactions and the number of them in flight
+class FakeDriver:
+
+    def __init__(self):
+        self.queries = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def session(self, **config):
+        return FakeSession(self)
+
+    async def close(self):
+        pass
+
+
+class FakeSession:
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def _execute(self, function, *args, **kwargs):
+        driver = self._driver
+        driver.in_flight += 1
+        driver.max_in_flight = max(driver.max_in_flight, driver.in_flight)
+        try:
+            await asyncio.sleep(0)
+            return await function(FakeTransaction(driver), *args, **kwargs)
+        finally:
+            driver.in_flight -= 1
+
+    execute_read = _execute
+    execute_write = _execute
+
+
+class FakeTransaction:
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    async def run(self, query, **parameters):
+        self._driver.queries.append((query, parameters))
+        return FakeResult()
+
+
+class FakeResult:
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+@pytest.fixture
+def driver(monkeypatch):
+    driver = FakeDriver()
+    monkeypatch.setattr(aio, 'async_driver', lambda uri, **pool_config: driver)
+    return driver
+
+
+# every row is written once, in batches of batch_size, with at most concurrency batches in flight
+def test_write_batches_bounded(driver):
+    rows = [{'name': 'C%d' % i} for i in range(10)]
+    generate = aio.AsyncGenerateTrainNetwork('neo4j://localhost:7687', batch_size=3, concurrency=2)
+    asyncio.run(generate._write_batches(MERGE_CITIES_QUERY, rows))
+
+    assert [len(parameters['rows']) for _, parameters in driver.queries] == [3, 3, 3, 1]
+    assert sorted(row['name'] for _, parameters in driver.queries for row in parameters['rows']) == \
+        sorted(row['name'] for row in rows)
+    assert driver.max_in_flight == 2
+
+
+# the cost is written on the lines before the projections and the spanning tree read them
+def test_create_writes_cost_first(driver, tmp_path):
+    cities = tmp_path / 'cities.csv'
+    cities.write_text('name;latitude;longitude;population\nBern;46.9;7.4;100\nThun;46.7;7.6;50\n')
+    lines = tmp_path / 'lines.csv'
+    lines.write_text('city1;city2;km;time;nbTracks\nBern;Thun;30;20;2\n')
+    generate = aio.AsyncGenerateTrainNetwork('neo4j://localhost:7687')
+    asyncio.run(generate.create(cities, lines))
+
+    queries = [query for query, _ in driver.queries]
+    cost = queries.index(ADD_COST_QUERY)
+    assert queries.index(MERGE_LINES_QUERY) < cost
+    assert all(queries.index(query) > cost for query in (CREATE_GRAPH_QUERY, CREATE_MINST_QUERY))
+    assert queries.count(CREATE_GRAPH_QUERY) == len(aio.PROJECTIONS)
+
+
+# concurrent callers share one fetch of the snapshot, which is started again after a failure
+def test_snapshot_shared_and_retried(driver):
+    display = aio.AsyncDisplayTrainNetwork('neo4j://localhost:7687')
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0)
+        if len(calls) == 1:
+            raise RuntimeError('connection lost')
+        return {'cities': []}
+
+    display._fetch_snapshot = fetch
+
+    async def main():
+        failed = await asyncio.gather(display.snapshot(), display.snapshot(), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in failed)
+        return await asyncio.gather(display.snapshot(), display.snapshot(), display.snapshot())
+
+    snapshots = asyncio.run(main())
+    assert len(calls) == 2
+    assert all(snapshot is snapshots[0] for snapshot in snapshots)
@@ -0,0 +1,65 @@
+import random
+
+import pandas as pd
+
+from index import line_key, update_minimum_spanning_tree
+from graph import TrainNetwork
+
+
+def make_cities(names):
+    return pd.DataFrame({'name': names, 'latitude': 0.0, 'longitude': 0.0, 'population': 1000})
+
+
+def make_lines(rows):
+    return pd.DataFrame(rows, columns=['city1', 'city2', 'km', 'time', 'nbTracks'])
+
+
+def full_tree(cities, lines, start='Bern'):
+    return {tuple(sorted((c1, c2))): (c1, c2, w) for c1, c2, w in TrainNetwork(cities, lines).prim(start, 'cost')}
+
+
+def tree_cost(tree):
+    return sum(w for _, _, w in tree.values())
+
+
+# an upserted line joining the component of Bern to another component brings its lines into the tree
+def test_line_joining_another_component():
+    cities = make_cities(['Bern', 'C1', 'C2', 'C3', 'C4', 'C5'])
+    old_lines = make_lines([('C3', 'C4', 10, 10, 1), ('C4', 'C5', 10, 10, 1), ('C1', 'C2', 10, 10, 1)])
+    tree = full_tree(cities, old_lines)
+    assert tree == {}
+
+    upsert = {'city1': 'Bern', 'city2': 'C2', 'km': 5, 'time': 5, 'nbTracks': 1}
+    lines = pd.concat([old_lines, make_lines([upsert])], ignore_index=True)
+    stored = {line_key(row): row for row in old_lines.to_dict('records')}
+    result = update_minimum_spanning_tree(cities, lines, tree, [upsert], [], stored)
+    assert set(result) == {('Bern', 'C2'), ('C1', 'C2')}
+    assert result == full_tree(cities, lines)
+
+
+# random changes of random networks give a tree as cheap as the one computed from all the lines
+def test_random_updates_match_full_prim():
+    rng = random.Random(0)
+    for _ in range(300):
+        names = ['Bern'] + ['C%d' % i for i in range(rng.randint(2, 9))]
+        cities = make_cities(names)
+        pairs = [tuple(sorted(rng.sample(names, 2))) for _ in range(rng.randint(1, 14))]
+        stored = {pair: {'city1': pair[0], 'city2': pair[1], 'km': rng.randint(1, 50), 'time': 1,
+                         'nbTracks': rng.randint(1, 3)} for pair in pairs}
+        tree = full_tree(cities, make_lines(list(stored.values())))
+
+        wanted = {k: dict(row) for k, row in stored.items() if rng.random() > 0.2}
+        for k in rng.sample(sorted(wanted), min(2, len(wanted))):
+            wanted[k]['km'] = rng.randint(1, 50)
+        for _ in range(rng.randint(0, 3)):
+            pair = tuple(sorted(rng.sample(names, 2)))
+            wanted[pair] = {'city1': pair[0], 'city2': pair[1], 'km': rng.randint(1, 50), 'time': 1,
+                            'nbTracks': rng.randint(1, 3)}
+        upserts = [row for k, row in wanted.items() if k not in stored or stored[k] != row]
+        deletes = [k for k in stored if k not in wanted]
+
+        lines = make_lines(list(wanted.values()))
+        result = update_minimum_spanning_tree(cities, lines, tree, upserts, deletes, stored)
+        expected = full_tree(cities, lines)
+        assert len(result) == len(expected)
+        assert abs(tree_cost(result) - tree_cost(expected)) < 1e-9
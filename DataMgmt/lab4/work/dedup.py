@@ -0,0 +1,178 @@
+#!/bin/env python
+"""
+Detection of the orders seen more than once, within a shop or across shops.
+
+An order line is identified by its KEY columns. The lines are reduced to
+64-bit hashes of their key, price and quantity, kept in sorted runs merged
+like the levels of a log-structured merge tree, so a stream of chunks is
+reconciled with about 26 bytes per distinct line and without keeping the
+lines themselves. A line whose key was already seen is a duplicate if its
+price and quantity are the same, and a conflict otherwise.
+
+The reconciliation only reports: the loads of ingest.py, stream.py and
+store.py do not go through it, so the repeated lines still reach the sales
+and the cube. Only the key and the number of repeats of each repeated key
+are kept, not the repeated lines.
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from ingest import DATA_FOLDER, SOURCES, clean, iter_source
+
+
+KEY = ['Order ID', 'Product', 'Order Date', 'Street Address', 'City', 'State']
+
+UNKNOWN = np.uint64(0)
+"""Hash of a missing quantity, which matches any quantity"""
+
+ENTRY = np.dtype([('key', 'u8'), ('price', 'u8'), ('quantity', 'u8'), ('shop', 'i2')])
+
+
+def row_hashes(df: pd.DataFrame, columns: list[str]) -> np.ndarray:
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+class Reconciler:
+    """
+    Streaming reconciliation of the order lines of all the shops.
+
+    Chunks of cleaned lines are given to add() in the order of the files, the
+    first occurrence of a key is the reference of the lines repeating it.
+    The chunks are only counted, not filtered.
+    """
+
+    def __init__(self):
+        self.shops: list[str] = []
+        self.runs: list[np.ndarray] = []
+        self.counts: dict[str, dict[str, int]] = {}
+        # (kind, shop, first shop, key hash) -> [values of the KEY columns, number of lines]
+        self._findings: dict[tuple[str, int, int, int], list] = {}
+
+    def _shop_index(self, shop: str) -> int:
+        if shop not in self.shops:
+            self.shops.append(shop)
+            self.counts[shop] = {'lines': 0, 'dropped': 0, 'duplicates': 0, 'conflicts': 0}
+        return self.shops.index(shop)
+
+    def _lookup(self, keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # entry of each key in the runs, and whether it was found
+        found = np.zeros(len(keys), dtype=bool)
+        entries = np.zeros(len(keys), dtype=ENTRY)
+        for run in self.runs:
+            pos = np.minimum(np.searchsorted(run['key'], keys), len(run) - 1)
+            hit = ~found & (run['key'][pos] == keys)
+            entries[hit] = run[pos[hit]]
+            found |= hit
+        return entries, found
+
+    def _insert(self, entries: np.ndarray):
+        # runs are merged while the last one is at least half the size of the previous one,
+        # so there are O(log n) runs and each entry is merged O(log n) times; no run is empty
+        if len(entries) == 0:
+            return
+        self.runs.append(entries[np.argsort(entries['key'], kind='stable')])
+        while len(self.runs) > 1 and 2 * len(self.runs[-1]) >= len(self.runs[-2]):
+            merged = np.concatenate(self.runs[-2:])
+            self.runs[-2:] = [merged[np.argsort(merged['key'], kind='stable')]]
+
+    def add(self, shop: str, chunk: pd.DataFrame, dropped: int = 0):
+        """
+        Reconcile a cleaned chunk of a shop. dropped is the number of raw lines cleaning removed.
+        """
+        index = self._shop_index(shop)
+        counts = self.counts[shop]
+        counts['lines'] += len(chunk)
+        counts['dropped'] += dropped
+        if len(chunk) == 0:
+            return
+
+        entries = np.zeros(len(chunk), dtype=ENTRY)
+        entries['key'] = row_hashes(chunk, KEY)
+        entries['price'] = row_hashes(chunk, ['Price Each'])
+        entries['quantity'] = np.where(chunk['Quantity Ordered'].isna(), UNKNOWN,
+                                       row_hashes(chunk, ['Quantity Ordered']))
+        entries['shop'] = index
+
+        # reference of each line: an entry of the runs, or the first line of the chunk with its key
+        references, seen = self._lookup(entries['key'])
+        first = pd.Series(np.arange(len(chunk))).groupby(entries['key']).transform('first').to_numpy()
+        repeated = seen | (first != np.arange(len(chunk)))
+        references[~seen] = entries[first[~seen]]
+
+        if repeated.any():
+            same_price = entries['price'] == references['price']
+            same_quantity = ((entries['quantity'] == references['quantity'])
+                             | (entries['quantity'] == UNKNOWN) | (references['quantity'] == UNKNOWN))
+            duplicate = repeated & same_price & same_quantity
+            conflict = repeated & ~duplicate
+            counts['duplicates'] += int(duplicate.sum())
+            counts['conflicts'] += int(conflict.sum())
+
+            found = chunk.loc[repeated, KEY].assign(
+                kind=np.where(duplicate[repeated], 'duplicate', 'conflict'),
+                first_shop=references['shop'][repeated], key=entries['key'][repeated])
+            grouped = found.groupby(['kind', 'first_shop', 'key'], sort=False)
+            firsts, sizes = grouped.first(), grouped.size()
+            for (kind, first_shop, key), values, size in zip(firsts.index, firsts.itertuples(index=False),
+                                                             sizes[firsts.index]):
+                finding = self._findings.setdefault((kind, index, int(first_shop), int(key)), [tuple(values), 0])
+                finding[1] += int(size)
+
+        self._insert(entries[~repeated])
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Lines, lines dropped by cleaning, duplicates and conflicts of each shop.
+        """
+        summary = pd.DataFrame.from_dict(self.counts, orient='index')
+        summary['distinct'] = summary['lines'] - summary['duplicates'] - summary['conflicts']
+        return summary
+
+    def findings(self) -> pd.DataFrame:
+        """
+        The repeated keys, with their kind, the shop repeating them, the shop
+        where they were first seen and the number of lines repeating them.
+        """
+        return pd.DataFrame(
+            [(kind, self.shops[shop], self.shops[first_shop], *values, count)
+             for (kind, shop, first_shop, _), (values, count) in self._findings.items()],
+            columns=['Kind', 'Shop', 'First Shop', *KEY, 'Count'])
+
+
+def reconcile(names: Optional[list[str]] = None, chunk_size: int = 50000,
+              data_folder: Path = DATA_FOLDER) -> Reconciler:
+    """
+    Reconcile the given shops (all by default) by streaming their files.
+    """
+    reconciler = Reconciler()
+    for name in (list(SOURCES) if names is None else names):
+        start = time.perf_counter()
+        for raw in iter_source(SOURCES[name], chunk_size, data_folder):
+            chunk = clean(raw, SOURCES[name])
+            reconciler.add(name, chunk, len(raw) - len(chunk))
+        logging.info(f"Reconciled {name} in {time.perf_counter() - start:.2f}s")
+    return reconciler
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Report the order lines repeated within and across shops.")
+    parser.add_argument("--chunk-size", type=int, default=50000,
+                        help="number of rows read at a time from each file")
+    parser.add_argument("--output", type=Path, metavar="FILE",
+                        help="write the repeated keys and their number of lines to the CSV file FILE")
+    args = parser.parse_args()
+
+    reconciler = reconcile(chunk_size=args.chunk_size)
+    print(reconciler.summary().to_string())
+    if args.output:
+        reconciler.findings().to_csv(args.output, index=False)
@@ -0,0 +1,60 @@
+"""
+Imputation of missing values from statistics of each product.
+
+The statistics are computed once, with one groupby per shop, into a lookup
+table indexed by product, which is then mapped on the rows to fill.
+"""
+from typing import Callable, Optional
+
+import pandas as pd
+
+
+STRATEGIES = ('mean', 'median', 'first', 'last')
+"""Statistics of the known values of a product, first and last in the order of the rows"""
+
+
+def _known(df: pd.DataFrame, column: str, ignore: Optional[Callable[[pd.Series], pd.Series]]) -> pd.Series:
+    values = df[column]
+    return values.mask(ignore(values)) if ignore is not None else values
+
+
+def product_statistics(frames: list[pd.DataFrame], column: str, strategy: str = 'mean',
+                       ignore: Optional[Callable[[pd.Series], pd.Series]] = None) -> pd.Series:
+    """
+    Lookup table of a statistic of a column for each product.
+
+    Missing values and the values for which ignore is true are left out. With
+    several frames, the statistic is computed in each one and averaged over
+    the frames that have the product.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy {strategy!r}, expected one of {STRATEGIES}")
+    tables = [_known(df, column, ignore).groupby(df['Product'], sort=False).agg(strategy) for df in frames]
+    return tables[0] if len(tables) == 1 else pd.concat(tables, axis=1).mean(axis=1)
+
+
+def overall_statistic(frames: list[pd.DataFrame], column: str, strategy: str = 'mean',
+                      ignore: Optional[Callable[[pd.Series], pd.Series]] = None) -> float:
+    """
+    The statistic of product_statistics over all the products, used for the products without any known value.
+    """
+    values = pd.concat([_known(df, column, ignore) for df in frames]).dropna()
+    if len(values) == 0:
+        return float('nan')
+    if strategy in ('first', 'last'):
+        return values.iloc[0 if strategy == 'first' else -1]
+    return values.agg(strategy)
+
+
+def impute(df: pd.DataFrame, column: str, table: pd.Series, missing: pd.Series,
+           default: Optional[float] = None) -> pd.DataFrame:
+    """
+    Replace the values of a column where missing is true by the value of their product in table.
+
+    Products that are not in table get default, or stay missing.
+    """
+    values = df['Product'].map(table)
+    if default is not None:
+        values = values.fillna(default)
+    df[column] = df[column].mask(missing, values)
+    return df
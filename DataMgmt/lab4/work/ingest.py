@@ -0,0 +1,357 @@
+#!/bin/env python
+"""
+Ingestion of the sales of the six shops into a common schema.
+
+Each shop is described in SOURCES by the format of its file, the options of
+its reader and the mapping of its columns to COLUMNS. Sources are read in
+parallel processes and cleaned with vectorized operations only, then the
+quantities missing from Shop 6 are estimated from the other shops.
+"""
+import argparse
+import json
+import logging
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+import openpyxl
+import pandas as pd
+import pyarrow.parquet as pq
+
+from impute import impute, overall_statistic, product_statistics
+
+
+COLUMNS = ['Order ID', 'Product', 'Quantity Ordered', 'Price Each', 'Order Date', 'Street Address', 'City', 'State']
+DATA_FOLDER = Path('data')
+
+SOURCES = {
+    'Shop 1': {
+        'path': 'Shop1.csv',
+        'format': 'csv',
+        'date_format': '%Y-%m-%d %H:%M:%S',
+    },
+    'Shop 2': {
+        'path': 'Shop2.xlsx',
+        'format': 'xlsx',
+    },
+    'Shop 3': {
+        # the header row is repeated in the data
+        'path': 'Shop3.json',
+        'format': 'json',
+        'options': {'orient': 'split'},
+        'date_format': '%m/%d/%y %H:%M',
+    },
+    'Shop 4': {
+        'path': 'Shop4.xml',
+        'format': 'xml',
+        'columns': {
+            'orderId': 'Order ID',
+            'product': 'Product',
+            'quantityOrdered': 'Quantity Ordered',
+            'priceEach': 'Price Each',
+            'orderDate': 'Order Date',
+        },
+        # 'street, city, state' split into the address columns
+        'address': 'purchaseAddress',
+        'date_format': '%Y-%m-%d %H:%M:%S',
+    },
+    'Shop 5': {
+        # some prices are 0, they are replaced by the first known price of the product
+        'path': 'Shop5.parquet',
+        'format': 'parquet',
+        'impute_zero_prices': 'first',
+    },
+    'Shop 6': {
+        # there is no quantity, it is estimated from the mean quantity of the product in the other shops
+        'path': 'Shop6.db',
+        'format': 'sqlite',
+        'options': {'table': 'sales'},
+        'columns': {
+            'orderId': 'Order ID',
+            'product': 'Product',
+            'priceEach': 'Price Each',
+            'orderDate': 'Order Date',
+            'streetAddress': 'Street Address',
+            'city': 'City',
+            'state': 'State',
+        },
+        'date_format': '%Y-%m-%d %H:%M:%S',
+        'impute_quantity': 'mean',
+    },
+}
+"""Description of the file of each shop, the imputations are done with one of impute.STRATEGIES"""
+
+
+def read_sqlite(path: Path, table: str, after_rowid: int = 0) -> pd.DataFrame:
+    # after_rowid only reads the rows appended since a previous read
+    with sqlite3.connect(path) as connection:
+        return pd.read_sql_query(f'SELECT * FROM {table} WHERE rowid > ?', connection, params=(after_rowid,))
+
+
+READERS: dict[str, Callable[..., pd.DataFrame]] = {
+    'csv': pd.read_csv,
+    'xlsx': pd.read_excel,
+    'json': pd.read_json,
+    'xml': pd.read_xml,
+    'parquet': pd.read_parquet,
+    'sqlite': read_sqlite,
+}
+"""Reader of each format, called with the path and the options of the source"""
+
+
+def read_source(source: dict, data_folder: Path = DATA_FOLDER) -> pd.DataFrame:
+    """
+    Read the file of a source as it is.
+    """
+    return READERS[source['format']](data_folder / source['path'], **source.get('options', {}))
+
+
+def iter_csv(path: Path, chunk_size: int, **options) -> Iterator[pd.DataFrame]:
+    with pd.read_csv(path, chunksize=chunk_size, **options) as reader:
+        yield from reader
+
+
+def iter_xlsx(path: Path, chunk_size: int) -> Iterator[pd.DataFrame]:
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        columns = next(rows)
+        while chunk := [row for _, row in zip(range(chunk_size), rows)]:
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        workbook.close()
+
+
+def iter_json_split(path: Path, chunk_size: int, orient: str = 'split',
+                    block_size: int = 1 << 20) -> Iterator[pd.DataFrame]:
+    """
+    Yield the rows of a JSON file in the 'split' orientation of pandas.
+
+    The file is read by blocks and the rows of "data" are decoded one by one,
+    "columns" must come before "data".
+    """
+    if orient != 'split':
+        raise ValueError(f"Only the 'split' orientation can be read by chunks, not {orient!r}")
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buffer, pos = '', 0
+
+        # next non blank character, reading more of the file if needed
+        def peek():
+            nonlocal buffer, pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                buffer, pos = f.read(block_size), 0
+                if not buffer:
+                    return ''
+
+        # next JSON value, which is a string or an array and so ends with its last character
+        def decode():
+            nonlocal buffer, pos
+            peek()
+            while True:
+                try:
+                    value, pos = decoder.raw_decode(buffer, pos)
+                    return value
+                except json.JSONDecodeError:
+                    block = f.read(block_size)
+                    if not block:
+                        raise
+                    buffer, pos = buffer[pos:] + block, 0
+
+        columns = None
+        if peek() != '{':
+            raise ValueError(f"{path} is not a JSON object")
+        pos += 1
+        while peek() not in ('}', ''):
+            if buffer[pos] == ',':
+                pos += 1
+                continue
+            key = decode()
+            peek()
+            pos += 1  # ':'
+            if key != 'data':
+                value = decode()
+                if key == 'columns':
+                    columns = value
+                continue
+            if columns is None:
+                raise ValueError(f"{path}: \"columns\" must come before \"data\"")
+            peek()
+            pos += 1  # '['
+            rows = []
+            while peek() != ']':
+                if buffer[pos] == ',':
+                    pos += 1
+                    continue
+                rows.append(decode())
+                if len(rows) == chunk_size:
+                    yield pd.DataFrame(rows, columns=columns)
+                    rows = []
+            pos += 1
+            if rows:
+                yield pd.DataFrame(rows, columns=columns)
+
+
+def iter_xml(path: Path, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Yield the rows of an XML file made of a root element with one element per row.
+    """
+    rows, depth, root = [], 0, None
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            root = element if root is None else root
+            continue
+        depth -= 1
+        if depth == 1:
+            rows.append({child.tag: child.text for child in element})
+            root.clear()
+            if len(rows) == chunk_size:
+                yield pd.DataFrame(rows)
+                rows = []
+    if rows:
+        yield pd.DataFrame(rows)
+
+
+def iter_parquet(path: Path, chunk_size: int) -> Iterator[pd.DataFrame]:
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        yield batch.to_pandas()
+
+
+def iter_sqlite(path: Path, chunk_size: int, table: str) -> Iterator[pd.DataFrame]:
+    # the rows are fetched from the cursor chunk_size at a time
+    with sqlite3.connect(path) as connection:
+        yield from pd.read_sql_query(f'SELECT * FROM {table}', connection, chunksize=chunk_size)
+
+
+CHUNK_READERS: dict[str, Callable[..., Iterator[pd.DataFrame]]] = {
+    'csv': iter_csv,
+    'xlsx': iter_xlsx,
+    'json': iter_json_split,
+    'xml': iter_xml,
+    'parquet': iter_parquet,
+    'sqlite': iter_sqlite,
+}
+"""Reader of each format by chunks of at most chunk_size rows, called like READERS"""
+
+
+def iter_source(source: dict, chunk_size: int, data_folder: Path = DATA_FOLDER) -> Iterator[pd.DataFrame]:
+    """
+    Read the file of a source as it is, by chunks of at most chunk_size rows.
+    """
+    return CHUNK_READERS[source['format']](data_folder / source['path'], chunk_size, **source.get('options', {}))
+
+
+def impute_zero_prices(df: pd.DataFrame, strategy: str = 'first') -> pd.DataFrame:
+    """
+    Replace the prices of 0 by a statistic of the non zero prices of the same
+    product, by default the first one.
+    """
+    zero = df['Price Each'] == 0
+    table = product_statistics([df], 'Price Each', strategy, ignore=lambda price: price == 0)
+    return impute(df, 'Price Each', table, zero)
+
+
+def clean(df: pd.DataFrame, source: dict) -> pd.DataFrame:
+    """
+    Map the columns of a source to COLUMNS and give them their types.
+
+    Rows with missing values and repeated header rows are dropped. The
+    quantity of a source without one is left empty, see impute_quantity, and
+    zero prices are kept, see impute_zero_prices. A chunk of a source can be
+    cleaned on its own.
+    """
+    df = df.rename(columns=source.get('columns', {}))
+    if 'address' in source:
+        df[['Street Address', 'City', 'State']] = df[source['address']].str.split(', ', n=2, expand=True)
+
+    df = df.dropna(how='any')
+    if df['Order ID'].dtype == object:
+        df = df[df['Order ID'].astype(str) != 'Order ID']
+
+    df = df.reindex(columns=COLUMNS)
+    df['Order ID'] = pd.to_numeric(df['Order ID']).astype('int64')
+    if not source.get('impute_quantity'):
+        df['Quantity Ordered'] = pd.to_numeric(df['Quantity Ordered']).astype('int64')
+    df['Price Each'] = pd.to_numeric(df['Price Each']).astype('float64')
+    df['Order Date'] = pd.to_datetime(df['Order Date'], format=source.get('date_format'))
+    return df.reset_index(drop=True)
+
+
+def load_source(name: str, data_folder: Path = DATA_FOLDER) -> pd.DataFrame:
+    """
+    Read and clean the file of a shop.
+    """
+    start = time.perf_counter()
+    df = clean(read_source(SOURCES[name], data_folder), SOURCES[name])
+    if SOURCES[name].get('impute_zero_prices'):
+        df = impute_zero_prices(df, SOURCES[name]['impute_zero_prices'])
+    logging.info(f"Loaded {name}: {len(df)} rows in {time.perf_counter() - start:.2f}s")
+    return df
+
+
+def impute_quantity(df: pd.DataFrame, others: list[pd.DataFrame], strategy: str = 'mean') -> pd.DataFrame:
+    """
+    Estimate the quantity of each order as a statistic of the quantities of its
+    product in each of the other shops, averaged over the shops and rounded.
+
+    Products sold by none of the other shops get the statistic of all their orders.
+    """
+    table = product_statistics(others, 'Quantity Ordered', strategy)
+    default = overall_statistic(others, 'Quantity Ordered', strategy)
+    df = impute(df, 'Quantity Ordered', table, df['Quantity Ordered'].isna(), default)
+    df['Quantity Ordered'] = df['Quantity Ordered'].round().astype('int64')
+    return df
+
+
+def load_shops(names: Optional[list[str]] = None, workers: int = 1,
+               data_folder: Path = DATA_FOLDER) -> dict[str, pd.DataFrame]:
+    """
+    Load the given shops (all by default) in `workers` processes.
+
+    The quantities of the shops without one are estimated from all the other
+    shops in SOURCES, which are loaded too if needed.
+    """
+    names = list(SOURCES) if names is None else list(names)
+    needed = list(names)
+    if any(SOURCES[name].get('impute_quantity') for name in names):
+        needed += [name for name in SOURCES if name not in needed and not SOURCES[name].get('impute_quantity')]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shops = dict(zip(needed, executor.map(load_source, needed, [data_folder] * len(needed))))
+    else:
+        shops = {name: load_source(name, data_folder) for name in needed}
+
+    others = [shops[name] for name in SOURCES if name in shops and not SOURCES[name].get('impute_quantity')]
+    for name in names:
+        if SOURCES[name].get('impute_quantity'):
+            shops[name] = impute_quantity(shops[name], others, SOURCES[name]['impute_quantity'])
+    return {name: shops[name] for name in names}
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Load the sales of the shops into the common schema.")
+    parser.add_argument("shops", nargs="*", metavar="SHOP",
+                        help=f"shops to load among {', '.join(SOURCES)}, all by default")
+    parser.add_argument("--workers", type=int, default=len(SOURCES),
+                        help="number of processes reading the files")
+    args = parser.parse_args()
+    for name in args.shops:
+        if name not in SOURCES:
+            parser.error(f"unknown shop {name!r}")
+
+    start = time.perf_counter()
+    shops = load_shops(args.shops or None, args.workers)
+    logging.info(f"Loaded {sum(len(df) for df in shops.values())} rows in {time.perf_counter() - start:.2f}s")
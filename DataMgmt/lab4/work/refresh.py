@@ -0,0 +1,230 @@
+#!/bin/env python
+"""
+Incremental refresh of the store: only the shop files that changed are read again.
+
+The manifest of the store records a fingerprint of each file and the cleaned
+rows of each shop are cached as Parquet, before the quantities of Shop 6 are
+estimated since they depend on the other shops. A refresh compares the files
+with the manifest, reloads the new and changed shops, reads only the appended
+rows of a SQLite table that grew, and replaces the partitions and cube cells
+of the shops whose rows changed.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from pathlib import Path
+
+import pandas as pd
+
+from ingest import DATA_FOLDER, SOURCES, clean, impute_quantity, impute_zero_prices, load_source, read_sqlite
+from store import STORE_FOLDER, consolidate, update_store
+
+
+MANIFEST = 'manifest.json'
+CACHE_FOLDER = 'cache'
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parquet_footer_hash(path: Path) -> str:
+    # the footer holds the schema and the statistics of the row groups, it is
+    # stored before the last 8 bytes, which are its length and b'PAR1'
+    with path.open('rb') as f:
+        f.seek(-8, os.SEEK_END)
+        length = int.from_bytes(f.read(4), 'little')
+        f.seek(-8 - length, os.SEEK_END)
+        return hashlib.sha256(f.read(length)).hexdigest()
+
+
+def rows_hash(connection: sqlite3.Connection, table: str, max_rowid: int) -> str:
+    """
+    Hash of the rows of a table whose rowid is at most max_rowid, in rowid order.
+    """
+    digest = hashlib.sha256()
+    for row in connection.execute(f'SELECT rowid, * FROM {table} WHERE rowid <= ? ORDER BY rowid', (max_rowid,)):
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+
+def _table_state(path: Path, table: str) -> dict:
+    with closing(sqlite3.connect(path)) as connection:
+        max_rowid, count = connection.execute(f'SELECT max(rowid), count(*) FROM {table}').fetchone()
+        max_rowid = max_rowid or 0
+        return {'max_rowid': max_rowid, 'count': count, 'rows_sha256': rows_hash(connection, table, max_rowid)}
+
+
+def file_stat(source: dict, data_folder: Path = DATA_FOLDER) -> dict:
+    """
+    Size and modification time of the file of a source.
+
+    Rows committed to a SQLite database in WAL mode stay in its -wal file
+    until a checkpoint, without changing the database file, so the size and
+    modification time of the -wal file are part of the stat of a SQLite source.
+    """
+    path = data_folder / source['path']
+    stat = path.stat()
+    result = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if source['format'] == 'sqlite':
+        wal = path.with_name(path.name + '-wal')
+        wal_stat = wal.stat() if wal.exists() else None
+        result['wal'] = None if wal_stat is None else [wal_stat.st_size, wal_stat.st_mtime_ns]
+    return result
+
+
+def fingerprint(source: dict, data_folder: Path = DATA_FOLDER) -> dict:
+    """
+    Stat and content fingerprint of the file of a source.
+
+    The content fingerprint is the footer of a Parquet file, the hash of the
+    other files and, for SQLite, also the number of rows, the greatest rowid
+    and the hash of the rows of the table, which tell whether rows were only
+    appended. The stat is taken once the table is read, since closing the
+    connection may checkpoint the -wal file into the database.
+    """
+    path = data_folder / source['path']
+    result = {}
+    if source['format'] == 'parquet':
+        result['footer'] = parquet_footer_hash(path)
+    else:
+        result['sha256'] = file_hash(path)
+    if source['format'] == 'sqlite':
+        result.update(_table_state(path, source['options']['table']))
+    return {**file_stat(source, data_folder), **result}
+
+
+def detect_change(source: dict, previous: dict, data_folder: Path = DATA_FOLDER) -> tuple[str, dict]:
+    """
+    Compare a file with its fingerprint in the manifest, returns its new
+    fingerprint and 'new', 'unchanged', 'appended' or 'changed'.
+
+    The content is only fingerprinted when the stat of the file changed. A
+    SQLite table was only appended to when its rows up to the previous
+    greatest rowid still have the same hash, else an update or a delete may
+    have come with the new rows.
+    """
+    path = data_folder / source['path']
+    if previous is not None:
+        stat = file_stat(source, data_folder)
+        if all(previous.get(k) == v for k, v in stat.items()):
+            return 'unchanged', previous
+
+    current = fingerprint(source, data_folder)
+    if previous is None:
+        return 'new', current
+    content = {k: v for k, v in current.items() if k not in ('size', 'mtime_ns', 'wal')}
+    if all(previous.get(k) == v for k, v in content.items()):
+        return 'unchanged', current
+    if source['format'] == 'sqlite' and current['max_rowid'] > previous['max_rowid']:
+        with closing(sqlite3.connect(path)) as connection:
+            kept = rows_hash(connection, source['options']['table'], previous['max_rowid'])
+        if kept == previous.get('rows_sha256'):
+            return 'appended', current
+    return 'changed', current
+
+
+def cache_path(folder: Path, name: str) -> Path:
+    return folder / CACHE_FOLDER / f'{name}.parquet'
+
+
+def reload_shop(name: str, status: str, previous: dict, folder: Path = STORE_FOLDER,
+                data_folder: Path = DATA_FOLDER) -> pd.DataFrame:
+    """
+    Clean the rows of a changed shop and cache them.
+    """
+    source = SOURCES[name]
+    start = time.perf_counter()
+    if status == 'appended':
+        appended = read_sqlite(data_folder / source['path'], source['options']['table'], previous['max_rowid'])
+        df = pd.concat([pd.read_parquet(cache_path(folder, name)), clean(appended, source)], ignore_index=True)
+        if source.get('impute_zero_prices'):
+            df = impute_zero_prices(df, source['impute_zero_prices'])
+        logging.info(f"Appended {len(appended)} rows to {name} in {time.perf_counter() - start:.2f}s")
+    else:
+        df = load_source(name, data_folder)
+
+    path = cache_path(folder, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp.parquet')
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+    return df
+
+
+def refresh(folder: Path = STORE_FOLDER, workers: int = 1, data_folder: Path = DATA_FOLDER) -> dict[str, str]:
+    """
+    Bring the store up to date with the shop files, returns the status of each shop.
+    """
+    manifest_path = folder / MANIFEST
+    manifest = {}
+    if manifest_path.exists():
+        with manifest_path.open() as f:
+            manifest = json.load(f)
+
+    statuses, fingerprints = {}, {}
+    for name, source in SOURCES.items():
+        previous = manifest.get(name) if cache_path(folder, name).exists() else None
+        statuses[name], fingerprints[name] = detect_change(source, previous, data_folder)
+    changed = [name for name, status in statuses.items() if status != 'unchanged']
+    logging.info(f"Shops to reload: {changed or 'none'}")
+
+    args = (changed, [statuses[name] for name in changed], [manifest.get(name) for name in changed],
+            [folder] * len(changed), [data_folder] * len(changed))
+    if workers > 1 and len(changed) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shops = dict(zip(changed, executor.map(reload_shop, *args)))
+    else:
+        shops = dict(zip(changed, map(reload_shop, *args)))
+
+    # the estimated quantities change with the quantities of any other shop
+    estimated = [name for name in SOURCES if SOURCES[name].get('impute_quantity')]
+    if any(name not in estimated for name in changed):
+        for name in estimated:
+            if name not in shops:
+                shops[name] = pd.read_parquet(cache_path(folder, name))
+    if any(name in shops for name in estimated):
+        others = [
+            shops[name] if name in shops else pd.read_parquet(cache_path(folder, name),
+                                                              columns=['Product', 'Quantity Ordered'])
+            for name in SOURCES if name not in estimated
+        ]
+        for name in estimated:
+            if name in shops:
+                shops[name] = impute_quantity(shops[name], others, SOURCES[name]['impute_quantity'])
+
+    if shops:
+        update_store(consolidate(shops), folder)
+    tmp = manifest_path.with_suffix('.tmp')
+    folder.mkdir(parents=True, exist_ok=True)
+    with tmp.open('w') as f:
+        json.dump(fingerprints, f, indent=2)
+    os.replace(tmp, manifest_path)
+    return statuses
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Refresh the store with the shop files that changed.")
+    parser.add_argument("--workers", type=int, default=6,
+                        help="number of processes reading the changed shop files")
+    parser.add_argument("--store", type=Path, default=STORE_FOLDER, metavar="DIR",
+                        help="folder of the store")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    statuses = refresh(args.store, args.workers)
+    logging.info(f"Refreshed {args.store} in {time.perf_counter() - start:.2f}s: {statuses}")
@@ -0,0 +1,183 @@
+#!/bin/env python
+"""
+Consolidated sales of all the shops, stored once as a Parquet dataset.
+
+The sales are partitioned by shop, with a precomputed revenue, month and
+hour and categorical text columns. The cube aggregates them by shop, month,
+city, hour and product: its size depends on these dimensions and not on the
+number of sales, so the reports are answered from it in milliseconds.
+"""
+import argparse
+import calendar
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from ingest import COLUMNS, load_shops
+
+
+STORE_FOLDER = Path('store')
+
+CATEGORIES = ['Shop', 'Product', 'City', 'State']
+DIMENSIONS = ['Shop', 'Month', 'City', 'State', 'Hour', 'Product']
+MEASURES = ['Revenue', 'Quantity Ordered', 'Orders']
+
+REPORTS = {
+    'sales_by_shop': (['Shop'], 'Revenue'),
+    'sales_by_month': (['Month'], 'Revenue'),
+    'sales_by_city': (['City', 'State'], 'Revenue'),
+    'orders_by_hour': (['Hour'], 'Orders'),
+    'sales_by_product': (['Product'], 'Revenue'),
+}
+"""Dimensions and measure of each report of the notebook"""
+
+
+def consolidate(shops: dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate the sales of the shops with a Shop column and the derived
+    Revenue, Month and Hour columns.
+    """
+    sales = pd.concat(shops, names=['Shop']).reset_index(level=0).reset_index(drop=True)
+    sales = sales[['Shop'] + COLUMNS]
+    sales['Revenue'] = sales['Price Each'] * sales['Quantity Ordered']
+    sales['Month'] = sales['Order Date'].dt.month.astype('int8')
+    sales['Hour'] = sales['Order Date'].dt.hour.astype('int8')
+    for column in CATEGORIES:
+        sales[column] = sales[column].astype('category')
+    return sales
+
+
+def build_cube(sales: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregate the sales by DIMENSIONS, one row per combination that occurs.
+
+    Orders counts the lines of the sales, like the notebook does.
+    """
+    cube = sales.groupby(DIMENSIONS, observed=True).agg(
+        **{
+            'Revenue': ('Revenue', 'sum'),
+            'Quantity Ordered': ('Quantity Ordered', 'sum'),
+            'Orders': ('Revenue', 'size'),
+        }
+    )
+    return cube.reset_index()
+
+
+def _replace(tmp: Path, path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+def write_store(sales: pd.DataFrame, folder: Path = STORE_FOLDER):
+    """
+    Write the sales partitioned by shop and their cube in folder.
+
+    Both are written next to the previous version and then moved in place, so
+    that readers never see a partial store.
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    tmp = folder / 'sales.tmp'
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    sales.to_parquet(tmp, partition_cols=['Shop'], index=False)
+    _replace(tmp, folder / 'sales')
+
+    _write_cube(build_cube(sales), folder)
+
+
+def _write_cube(cube: pd.DataFrame, folder: Path):
+    tmp = folder / 'cube.tmp.parquet'
+    cube.to_parquet(tmp, index=False)
+    os.replace(tmp, folder / 'cube.parquet')
+
+
+def update_store(sales: pd.DataFrame, folder: Path = STORE_FOLDER):
+    """
+    Replace the partitions and the cube cells of the shops in sales, the other
+    shops of the store are kept as they are.
+
+    Each partition is written next to the previous one and then moved in place.
+    """
+    sales = sales.copy()
+    sales['Shop'] = sales['Shop'].astype('category').cat.remove_unused_categories()
+    tmp = folder / 'sales.tmp'
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    sales.to_parquet(tmp, partition_cols=['Shop'], index=False)
+    (folder / 'sales').mkdir(parents=True, exist_ok=True)
+    for partition in tmp.iterdir():
+        _replace(partition, folder / 'sales' / partition.name)
+    tmp.rmdir()
+
+    shops = list(sales['Shop'].cat.categories)
+    cube = build_cube(sales)
+    if (folder / 'cube.parquet').exists():
+        old = read_cube(folder)
+        cube = pd.concat([old[~old['Shop'].isin(shops)], cube], ignore_index=True)
+        for column in CATEGORIES:
+            cube[column] = cube[column].astype('category')
+    _write_cube(cube, folder)
+
+
+def read_sales(folder: Path = STORE_FOLDER, shops: Optional[list[str]] = None,
+               columns: Optional[list[str]] = None) -> pd.DataFrame:
+    """
+    Read the sales of the given shops (all by default), only reading their partitions.
+    """
+    filters = [('Shop', 'in', shops)] if shops is not None else None
+    return pd.read_parquet(folder / 'sales', columns=columns, filters=filters)
+
+
+def read_cube(folder: Path = STORE_FOLDER) -> pd.DataFrame:
+    return pd.read_parquet(folder / 'cube.parquet')
+
+
+def rollup(cube: pd.DataFrame, dimensions: list[str], measure: str = 'Revenue') -> pd.Series:
+    """
+    Sum a measure of the cube over all the dimensions but the given ones.
+    """
+    return cube.groupby(dimensions, observed=True)[measure].sum()
+
+
+def report(cube: pd.DataFrame, name: str) -> pd.Series:
+    """
+    One of the REPORTS, months are named like in the notebook.
+    """
+    dimensions, measure = REPORTS[name]
+    result = rollup(cube, dimensions, measure)
+    if dimensions == ['Month']:
+        result.index = [calendar.month_name[m] for m in result.index]
+    return result
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Build the consolidated sales store and print the reports.")
+    parser.add_argument("--workers", type=int, default=6,
+                        help="number of processes reading the shop files")
+    parser.add_argument("--store", type=Path, default=STORE_FOLDER, metavar="DIR",
+                        help="folder of the store")
+    parser.add_argument("--reports-only", action="store_true",
+                        help="print the reports of the existing store without building it")
+    args = parser.parse_args()
+
+    if not args.reports_only:
+        start = time.perf_counter()
+        write_store(consolidate(load_shops(workers=args.workers)), args.store)
+        logging.info(f"Built {args.store} in {time.perf_counter() - start:.2f}s")
+
+    cube = read_cube(args.store)
+    for name in REPORTS:
+        start = time.perf_counter()
+        result = report(cube, name)
+        logging.info(f"{name} in {(time.perf_counter() - start) * 1000:.1f}ms, "
+                     f"best: {result.idxmax()} with {round(result.max())}")
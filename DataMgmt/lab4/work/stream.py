@@ -0,0 +1,174 @@
+#!/bin/env python
+"""
+Streaming mode: the cube of store.py built from the shop files read by chunks.
+
+Each chunk is reduced to a partial cube and partial cubes are merged by
+summing them, so the memory used depends on the chunk size and the number of
+cells of the cube, not on the size of the files. The imputations that need a
+whole file, or all the other shops, are deferred: the partial cubes keep the
+quantities of the zero price lines and the prices of the lines without
+quantity, which are multiplied by the imputed values once everything is read.
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from ingest import DATA_FOLDER, SOURCES, clean, iter_source
+from store import CATEGORIES, DIMENSIONS, MEASURES, STORE_FOLDER
+
+
+STREAMING_STRATEGIES = {'impute_zero_prices': ('first', 'last'), 'impute_quantity': ('mean',)}
+"""Imputation strategies that can be computed from mergeable partial results"""
+
+
+def check_strategies(source: dict):
+    for imputation, strategies in STREAMING_STRATEGIES.items():
+        if source.get(imputation) and source[imputation] not in strategies:
+            raise ValueError(f"{imputation} {source[imputation]!r} cannot be streamed, only {strategies}")
+
+
+def partial_cube(shop: str, chunk: pd.DataFrame, source: dict) -> pd.DataFrame:
+    """
+    Aggregate a cleaned chunk of a shop by DIMENSIONS.
+
+    Besides the MEASURES, the partial cube sums the quantities of the lines
+    with a zero price to impute (Pending Quantity), and the prices and number
+    of the lines without quantity (Price Sum, Unknown Quantity).
+    """
+    price = chunk['Price Each']
+    quantity = chunk['Quantity Ordered'].fillna(0)
+    zero_price = (price == 0) if source.get('impute_zero_prices') else pd.Series(False, index=chunk.index)
+    unknown_quantity = chunk['Quantity Ordered'].isna()
+
+    lines = pd.DataFrame({
+        'Shop': shop,
+        'Month': chunk['Order Date'].dt.month.astype('int8'),
+        'City': chunk['City'],
+        'State': chunk['State'],
+        'Hour': chunk['Order Date'].dt.hour.astype('int8'),
+        'Product': chunk['Product'],
+        'Revenue': (price * quantity).where(~zero_price, 0.0),
+        'Quantity Ordered': quantity,
+        'Orders': 1,
+        'Pending Quantity': quantity.where(zero_price, 0),
+        'Price Sum': price.where(unknown_quantity, 0.0),
+        'Unknown Quantity': unknown_quantity.astype('int64'),
+    })
+    return lines.groupby(DIMENSIONS, observed=True).sum()
+
+
+def merge(partials: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Merge partial cubes into one.
+    """
+    return pd.concat(partials).groupby(level=DIMENSIONS, observed=True).sum()
+
+
+def stream_shop(name: str, chunk_size: int = 50000,
+                data_folder: Path = DATA_FOLDER) -> tuple[pd.DataFrame, dict[str, float]]:
+    """
+    Partial cube of a shop and the price of each of its products used for the
+    zero prices, the first or last non zero one.
+    """
+    source = SOURCES[name]
+    check_strategies(source)
+    start = time.perf_counter()
+    cube = None
+    known_prices = {}
+    for chunk in iter_source(source, chunk_size, data_folder):
+        chunk = clean(chunk, source)
+        if source.get('impute_zero_prices'):
+            strategy = source['impute_zero_prices']
+            prices = chunk.loc[chunk['Price Each'] != 0].groupby('Product', sort=False)['Price Each'].agg(strategy)
+            if strategy == 'first':
+                prices = {product: price for product, price in prices.items() if product not in known_prices}
+            known_prices.update(prices)
+        partial = partial_cube(name, chunk, source)
+        cube = partial if cube is None else merge([cube, partial])
+    logging.info(f"Streamed {name}: {len(cube)} cells in {time.perf_counter() - start:.2f}s")
+    return cube, known_prices
+
+
+def finalize(cube: pd.DataFrame, known_prices: dict[str, dict[str, float]]) -> pd.DataFrame:
+    """
+    Apply the deferred imputations to a merged cube, the same as ingest.load_shops does.
+
+    known_prices are the prices used for the zero prices of the products of each shop.
+    """
+    cube = cube.reset_index()
+
+    price = pd.Series([known_prices.get(shop, {}).get(product) for shop, product in
+                       zip(cube['Shop'], cube['Product'])], index=cube.index, dtype='float64')
+    cube['Revenue'] += (cube['Pending Quantity'] * price).fillna(0)
+
+    # mean over the other shops of the mean quantity of each product
+    known = cube[~cube['Shop'].isin([name for name in SOURCES if SOURCES[name].get('impute_quantity')])]
+    if len(known) and cube['Unknown Quantity'].any():
+        per_shop = known.groupby(['Shop', 'Product'], observed=True)[['Quantity Ordered', 'Orders']].sum()
+        means = (per_shop['Quantity Ordered'] / per_shop['Orders']).groupby(level='Product').mean()
+        overall = known['Quantity Ordered'].sum() / known['Orders'].sum()
+        quantity = cube['Product'].map(means).fillna(overall).round()
+        cube['Revenue'] += cube['Price Sum'] * quantity
+        cube['Quantity Ordered'] += cube['Unknown Quantity'] * quantity
+
+    cube['Quantity Ordered'] = cube['Quantity Ordered'].astype('int64')
+    for column in CATEGORIES:
+        cube[column] = cube[column].astype('category')
+    return cube[DIMENSIONS + MEASURES]
+
+
+def stream_cube(names: Optional[list[str]] = None, chunk_size: int = 50000, workers: int = 1,
+                data_folder: Path = DATA_FOLDER) -> pd.DataFrame:
+    """
+    Cube of the given shops (all by default), streamed in `workers` processes.
+
+    Like ingest.load_shops, the quantities of the shops without one are
+    estimated from all the other shops, which are read too if needed.
+    """
+    names = list(SOURCES) if names is None else list(names)
+    needed = list(names)
+    if any(SOURCES[name].get('impute_quantity') for name in names):
+        needed += [name for name in SOURCES if name not in needed and not SOURCES[name].get('impute_quantity')]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(stream_shop, needed, [chunk_size] * len(needed),
+                                        [data_folder] * len(needed)))
+    else:
+        results = [stream_shop(name, chunk_size, data_folder) for name in needed]
+
+    cube = finalize(merge([partial for partial, _ in results]),
+                    {name: known_prices for name, (_, known_prices) in zip(needed, results)})
+    cube = cube[cube['Shop'].isin(names)].reset_index(drop=True)
+    for column in CATEGORIES:
+        cube[column] = cube[column].cat.remove_unused_categories()
+    return cube
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Build the cube of the store by streaming the shop files.")
+    parser.add_argument("--chunk-size", type=int, default=50000,
+                        help="number of rows read at a time from each file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes streaming the files")
+    parser.add_argument("--store", type=Path, default=STORE_FOLDER, metavar="DIR",
+                        help="folder of the store")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cube = stream_cube(chunk_size=args.chunk_size, workers=args.workers)
+    args.store.mkdir(parents=True, exist_ok=True)
+    tmp = args.store / 'cube.tmp.parquet'
+    cube.to_parquet(tmp, index=False)
+    os.replace(tmp, args.store / 'cube.parquet')
+    logging.info(f"Streamed {len(cube)} cells to {args.store} in {time.perf_counter() - start:.2f}s")